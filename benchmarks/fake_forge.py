@@ -0,0 +1,549 @@
+"""
+Offline stand-in for the Laravel Forge API.
+
+Models servers, sites, domains, daemons, scheduled jobs, php versions, nginx
+templates, certificates and deployments in memory. Every resource that Forge
+provisions asynchronously (sites, repositories, php versions, certificates,
+deployments) reports an in-progress status until `transition_delay` seconds after
+its creation. Each request is delayed by `latency` seconds and counted per
+endpoint template (e.g. `GET /servers/{id}/sites`). GET responses carry an ETag
+and conditional requests are answered with `304 Not Modified`.
+
+Run it standalone to point `src/main.py` at it:
+
+    python benchmarks/fake_forge.py --port 8080 --server test
+    FORGE_API_URL=http://127.0.0.1:8080/api python src/main.py
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+
+def _php_label(version):
+    # php84 -> PHP 8.4
+    digits = version.lower().replace("php", "").replace(".", "")
+    return f"PHP {digits[0]}.{digits[1:]}"
+
+
+def _php_binary(version):
+    # php84 -> php8.4
+    digits = version.lower().replace("php", "").replace(".", "")
+    return f"php{digits[0]}.{digits[1:]}"
+
+
+class FakeForge:
+    """In-memory Forge state and request router."""
+
+    def __init__(
+        self,
+        servers=("test",),
+        php_versions=("php84",),
+        latency=0.0,
+        transition_delay=0.0,
+        page_size=50,
+    ):
+        self.latency = latency
+        self.transition_delay = transition_delay
+        self.page_size = page_size
+
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self._ids = itertools.count(1)
+
+        self.servers = {}
+        self.sites = {}
+        self.domains = {}
+        self.certificates = {}
+        self.php_versions = {}
+        self.daemons = {}
+        self.jobs = {}
+        self.nginx_templates = {}
+        self.deployments = {}
+
+        for name in servers:
+            server_id = next(self._ids)
+            self.servers[server_id] = {"id": server_id, "name": name}
+            for version in php_versions:
+                self._add_php_version(server_id, version, created_at=0)
+
+        route = lambda method, path, handler: (
+            method,
+            path,
+            re.compile("^" + re.sub(r"\{id\}", r"(\\d+)", path) + "$"),
+            handler,
+        )
+        self.routes = [
+            route("GET", "/servers", self.list_servers),
+            route("GET", "/servers/{id}/sites", self.list_sites),
+            route("POST", "/servers/{id}/sites", self.create_site),
+            route("GET", "/sites/{id}", self.get_site),
+            route("PUT", "/servers/{id}/sites/{id}", self.update_site),
+            route(
+                "GET", "/servers/{id}/sites/{id}/deployments/script", self.get_script
+            ),
+            route(
+                "PUT", "/servers/{id}/sites/{id}/deployments/script", self.set_script
+            ),
+            route("GET", "/servers/{id}/sites/{id}/environment", self.get_env),
+            route("PUT", "/servers/{id}/sites/{id}/environment", self.set_env),
+            route("POST", "/servers/{id}/sites/{id}/deployments", self.deploy),
+            route(
+                "GET", "/servers/{id}/sites/{id}/deployments/{id}", self.get_deployment
+            ),
+            route(
+                "GET",
+                "/servers/{id}/sites/{id}/deployments/{id}/log",
+                self.get_deployment_log,
+            ),
+            route("GET", "/servers/{id}/nginx/templates", self.list_templates),
+            route("POST", "/servers/{id}/nginx/templates", self.create_template),
+            route("DELETE", "/servers/{id}/nginx/templates/{id}", self.delete_template),
+            route("GET", "/servers/{id}/sites/{id}/nginx", self.get_nginx),
+            route("PUT", "/servers/{id}/sites/{id}/nginx", self.set_nginx),
+            route("GET", "/servers/{id}/sites/{id}/domains", self.list_domains),
+            route("POST", "/servers/{id}/sites/{id}/domains", self.create_domain),
+            route(
+                "DELETE", "/servers/{id}/sites/{id}/domains/{id}", self.delete_domain
+            ),
+            route(
+                "GET",
+                "/servers/{id}/sites/{id}/domains/{id}/certificate",
+                self.get_certificate,
+            ),
+            route(
+                "POST",
+                "/servers/{id}/sites/{id}/domains/{id}/certificate",
+                self.create_certificate,
+            ),
+            route("GET", "/servers/{id}/php/versions", self.list_php_versions),
+            route("POST", "/servers/{id}/php/versions", self.install_php_version),
+            route("GET", "/servers/{id}/background-processes", self.list_daemons),
+            route("POST", "/servers/{id}/background-processes", self.create_daemon),
+            route(
+                "DELETE", "/servers/{id}/background-processes/{id}", self.delete_daemon
+            ),
+            route("GET", "/servers/{id}/scheduled-jobs", self.list_jobs),
+            route("POST", "/servers/{id}/scheduled-jobs", self.create_job),
+            route("DELETE", "/servers/{id}/scheduled-jobs/{id}", self.delete_job),
+        ]
+
+    # --- helpers ---
+
+    def _status(self, created_at, pending="installing", done="installed"):
+        if time.monotonic() - created_at < self.transition_delay:
+            return pending
+        return done
+
+    def _page(self, items, path, query):
+        page = int(query.get("page", 1))
+        start = (page - 1) * self.page_size
+        body = {"data": items[start : start + self.page_size], "links": {"next": None}}
+        if start + self.page_size < len(items):
+            body["links"]["next"] = f"{path}?{urlencode({**query, 'page': page + 1})}"
+        return 200, body
+
+    def _add_php_version(self, server_id, version, created_at):
+        php_id = next(self._ids)
+        self.php_versions[php_id] = {
+            "id": php_id,
+            "server_id": server_id,
+            "version": version,
+            "created_at": created_at,
+        }
+        return php_id
+
+    def _add_domain(self, site_id, name, domain_type):
+        domain_id = next(self._ids)
+        self.domains[domain_id] = {
+            "id": domain_id,
+            "site_id": site_id,
+            "name": name,
+            "type": domain_type,
+        }
+        return domain_id
+
+    # --- serializers ---
+
+    def _site(self, site):
+        status = self._status(site["created_at"])
+        return {
+            "id": site["id"],
+            "type": "sites",
+            "attributes": {
+                "name": site["name"],
+                "status": status,
+                "php_version": _php_label(site["php_version"]),
+                "quick_deploy": site["quick_deploy"],
+                "repository": {
+                    "branch": site["branch"],
+                    "status": status if site["repository"] else None,
+                },
+            },
+        }
+
+    def _php(self, php):
+        return {
+            "id": php["id"],
+            "type": "php-versions",
+            "attributes": {
+                "version": php["version"],
+                "binary_name": _php_binary(php["version"]),
+                "status": self._status(php["created_at"]),
+            },
+        }
+
+    def _deployment_status(self, deployment):
+        return self._status(deployment["created_at"], "deploying", "finished")
+
+    # --- servers ---
+
+    def list_servers(self, ids, query, body, path):
+        name = query.get("filter[name]", "")
+        servers = [
+            {"id": s["id"], "type": "servers", "attributes": {"name": s["name"]}}
+            for s in self.servers.values()
+            if name in s["name"]
+        ]
+        return self._page(servers, path, query)
+
+    # --- sites ---
+
+    def list_sites(self, ids, query, body, path):
+        sites = [self._site(s) for s in self.sites.values() if s["server_id"] == ids[0]]
+        return self._page(sites, path, query)
+
+    def create_site(self, ids, query, body, path):
+        name = (
+            body["name"]
+            if body.get("domain_mode") == "custom"
+            else f"{body['name']}.on-forge.com"
+        )
+        site_id = next(self._ids)
+        template = self.nginx_templates.get(body.get("nginx_template_id"))
+        nginx = f"server_name {name};"
+        if template:
+            # Forge fills its reserved variables when rendering a template
+            forge_variables = {"SITE_ID": site_id, "SITE": name, "DOMAINS": name}
+            nginx = re.sub(
+                r"{{\s*(SITE_ID|SITE|DOMAINS)\s*}}",
+                lambda m: str(forge_variables[m.group(1)]),
+                template["content"],
+            )
+        self.sites[site_id] = {
+            "id": site_id,
+            "server_id": ids[0],
+            "name": name,
+            "php_version": body.get("php_version", "php84"),
+            "quick_deploy": body.get("push_to_deploy", False),
+            "branch": body.get("branch"),
+            "repository": body.get("repository"),
+            "created_at": time.monotonic(),
+            "nginx": nginx,
+            "script": "",
+            "environment": "",
+        }
+        self._add_domain(site_id, name, "primary")
+        return 201, {"data": self._site(self.sites[site_id])}
+
+    def get_site(self, ids, query, body, path):
+        return 200, {"data": self._site(self.sites[ids[0]])}
+
+    def update_site(self, ids, query, body, path):
+        site = self.sites[ids[1]]
+        if "repository_branch" in body:
+            site["branch"] = body["repository_branch"]
+        if "push_to_deploy" in body:
+            site["quick_deploy"] = body["push_to_deploy"]
+        if "php_version" in body:
+            site["php_version"] = body["php_version"]
+        return 200, {"data": self._site(site)}
+
+    def get_script(self, ids, query, body, path):
+        return 200, {"data": {"attributes": {"content": self.sites[ids[1]]["script"]}}}
+
+    def set_script(self, ids, query, body, path):
+        self.sites[ids[1]]["script"] = body["content"]
+        return 200, {"data": {"attributes": {"content": body["content"]}}}
+
+    def get_env(self, ids, query, body, path):
+        content = self.sites[ids[1]]["environment"]
+        return 200, {"data": {"attributes": {"content": content}}}
+
+    def set_env(self, ids, query, body, path):
+        self.sites[ids[1]]["environment"] = body["environment"]
+        return 200, None
+
+    # --- deployments ---
+
+    def deploy(self, ids, query, body, path):
+        deployment_id = next(self._ids)
+        self.deployments[deployment_id] = {
+            "id": deployment_id,
+            "site_id": ids[1],
+            "created_at": time.monotonic(),
+        }
+        return 201, {"data": {"id": deployment_id, "attributes": {"status": "queued"}}}
+
+    def get_deployment(self, ids, query, body, path):
+        deployment = self.deployments[ids[2]]
+        status = self._deployment_status(deployment)
+        return 200, {"data": {"id": deployment["id"], "attributes": {"status": status}}}
+
+    def get_deployment_log(self, ids, query, body, path):
+        deployment = self.deployments[ids[2]]
+        # the log grows while the deployment runs
+        elapsed = time.monotonic() - deployment["created_at"]
+        progress = 1 if not self.transition_delay else elapsed / self.transition_delay
+        lines = [f"step {i + 1}/10 done" for i in range(min(10, int(progress * 10)))]
+        output = "\n".join(lines)
+        return 200, {"data": {"attributes": {"output": output}}}
+
+    # --- nginx ---
+
+    def list_templates(self, ids, query, body, path):
+        name = query.get("filter[name]", "")
+        templates = [
+            {"id": t["id"], "attributes": {"name": t["name"]}}
+            for t in self.nginx_templates.values()
+            if t["server_id"] == ids[0] and name in t["name"]
+        ]
+        return self._page(templates, path, query)
+
+    def create_template(self, ids, query, body, path):
+        template_id = next(self._ids)
+        self.nginx_templates[template_id] = {
+            "id": template_id,
+            "server_id": ids[0],
+            "name": body["name"],
+            "content": body["content"],
+        }
+        return 201, {"data": {"id": template_id, "attributes": {"name": body["name"]}}}
+
+    def delete_template(self, ids, query, body, path):
+        self.nginx_templates.pop(ids[1], None)
+        return 204, None
+
+    def get_nginx(self, ids, query, body, path):
+        return 200, {"data": {"attributes": {"content": self.sites[ids[1]]["nginx"]}}}
+
+    def set_nginx(self, ids, query, body, path):
+        self.sites[ids[1]]["nginx"] = body["config"]
+        return 200, None
+
+    # --- domains & certificates ---
+
+    def list_domains(self, ids, query, body, path):
+        domains = [
+            {"id": d["id"], "attributes": {"name": d["name"], "type": d["type"]}}
+            for d in self.domains.values()
+            if d["site_id"] == ids[1]
+        ]
+        return self._page(domains, path, query)
+
+    def create_domain(self, ids, query, body, path):
+        domain_id = self._add_domain(ids[1], body["name"], "alias")
+        return 201, {"data": {"id": domain_id, "attributes": {"name": body["name"]}}}
+
+    def delete_domain(self, ids, query, body, path):
+        self.domains.pop(ids[2], None)
+        self.certificates.pop(ids[2], None)
+        return 204, None
+
+    def get_certificate(self, ids, query, body, path):
+        created_at = self.certificates.get(ids[2])
+        if created_at is None:
+            return 404, {"message": "Not Found"}
+        status = self._status(created_at)
+        return 200, {"data": {"id": ids[2], "attributes": {"status": status}}}
+
+    def create_certificate(self, ids, query, body, path):
+        self.certificates[ids[2]] = time.monotonic()
+        return 201, {"data": {"id": ids[2], "attributes": {"status": "installing"}}}
+
+    # --- php ---
+
+    def list_php_versions(self, ids, query, body, path):
+        version = query.get("filter[version]")
+        versions = [
+            self._php(p)
+            for p in self.php_versions.values()
+            if p["server_id"] == ids[0] and version in (None, p["version"])
+        ]
+        return self._page(versions, path, query)
+
+    def install_php_version(self, ids, query, body, path):
+        for php in self.php_versions.values():
+            if php["server_id"] == ids[0] and php["version"] == body["version"]:
+                return 422, {"message": "The version has already been taken."}
+        php_id = self._add_php_version(ids[0], body["version"], time.monotonic())
+        return 201, {"data": self._php(self.php_versions[php_id])}
+
+    # --- daemons & jobs ---
+
+    def list_daemons(self, ids, query, body, path):
+        daemons = [
+            {"id": d["id"], "attributes": d["attributes"]}
+            for d in self.daemons.values()
+            if d["server_id"] == ids[0]
+        ]
+        return self._page(daemons, path, query)
+
+    def create_daemon(self, ids, query, body, path):
+        daemon_id = next(self._ids)
+        self.daemons[daemon_id] = {
+            "id": daemon_id,
+            "server_id": ids[0],
+            "attributes": {
+                "command": body["command"],
+                "directory": body["directory"],
+                "user": body["user"],
+            },
+        }
+        daemon = self.daemons[daemon_id]
+        return 201, {"data": {"id": daemon_id, "attributes": daemon["attributes"]}}
+
+    def delete_daemon(self, ids, query, body, path):
+        self.daemons.pop(ids[1], None)
+        return 204, None
+
+    def list_jobs(self, ids, query, body, path):
+        jobs = [
+            {"id": j["id"], "attributes": j["attributes"]}
+            for j in self.jobs.values()
+            if j["server_id"] == ids[0]
+        ]
+        return self._page(jobs, path, query)
+
+    def create_job(self, ids, query, body, path):
+        job_id = next(self._ids)
+        self.jobs[job_id] = {
+            "id": job_id,
+            "server_id": ids[0],
+            "attributes": {"command": body["command"], "frequency": body["frequency"]},
+        }
+        return 201, {
+            "data": {"id": job_id, "attributes": self.jobs[job_id]["attributes"]}
+        }
+
+    def delete_job(self, ids, query, body, path):
+        self.jobs.pop(ids[1], None)
+        return 204, None
+
+    # --- dispatch ---
+
+    def handle(self, method, path, query, body):
+        """Route a request. `path` is relative to `/api/orgs/{org}`."""
+        for route_method, template, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                ids = [int(i) for i in match.groups()]
+                with self.lock:
+                    self.calls[f"{method} {template}"] += 1
+                    try:
+                        return handler(ids, query, body, path)
+                    except KeyError:
+                        return 404, {"message": "Not Found"}
+
+        with self.lock:
+            self.calls[f"{method} <unknown>"] += 1
+        return 404, {"message": "Not Found"}
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    forge: FakeForge
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self):
+        if self.forge.latency:
+            time.sleep(self.forge.latency)
+
+        url = urlsplit(self.path)
+        match = re.match(r"^/api/orgs/[^/]+(/.*)$", url.path)
+        if not self.headers.get("Authorization") or not match:
+            return self._send(401 if match else 404, {"message": "Unauthenticated."})
+
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        status, data = self.forge.handle(
+            self.command, match.group(1), dict(parse_qsl(url.query)), body
+        )
+        self._send(status, data)
+
+    def _send(self, status, data):
+        payload = json.dumps(data).encode() if data is not None else b""
+        etag = None
+        if self.command == "GET" and status == 200:
+            # weak validator of the body, answered with a 304 when the client has it
+            etag = f'W/"{hashlib.sha1(payload).hexdigest()[:16]}"'
+            if self.headers.get("If-None-Match") == etag:
+                status, payload = 304, b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+
+class FakeForgeServer:
+    """Serves a `FakeForge` on a background thread: `with FakeForgeServer(forge) as url: ...`"""
+
+    def __init__(self, forge: FakeForge, host="127.0.0.1", port=0):
+        handler = type("Handler", (_Handler,), {"forge": forge})
+        self.forge = forge
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/api"
+
+    def __enter__(self):
+        self.thread.start()
+        return self.url
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake Laravel Forge API")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--server", action="append", default=None)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--transition-delay", type=float, default=1.0)
+    parser.add_argument("--page-size", type=int, default=50)
+    args = parser.parse_args()
+
+    forge = FakeForge(
+        servers=args.server or ["test"],
+        latency=args.latency,
+        transition_delay=args.transition_delay,
+        page_size=args.page_size,
+    )
+    server = FakeForgeServer(forge, port=args.port)
+    print(f"Fake Forge API listening on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
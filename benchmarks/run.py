@@ -0,0 +1,169 @@
+"""
+End-to-end benchmark: runs `src/main.py` against the fake Forge API with
+synthetic deployment files and reports wall time and API calls per endpoint.
+
+Each scenario runs twice against the same fake server: a first run that creates
+every site, then a second run where everything already exists. With `--cache`,
+both runs share an API cache directory, so the second run starts warm.
+
+    python benchmarks/run.py
+    python benchmarks/run.py --sites 1,10 --latency 0.05 --json bench.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import yaml
+
+from fake_forge import FakeForge, FakeForgeServer
+
+MAIN_PATH = Path(__file__).resolve().parent.parent / "src" / "main.py"
+
+
+def make_config(site_count: int, server="bench"):
+    """Build a deployment file with a mix of site kinds."""
+    sites = []
+    for i in range(site_count):
+        if i % 3 == 0:
+            sites.append(
+                {
+                    "name": f"app-{i}",
+                    "php_version": "php84",
+                    "laravel_scheduler": True,
+                    "deployment_script": "composer install --no-dev\n",
+                    "processes": [
+                        {"name": "queue", "command": "php artisan queue:work"}
+                    ],
+                    "environment": f"APP_NAME=app-{i}\nAPP_ENV=production\n",
+                }
+            )
+        elif i % 3 == 1:
+            sites.append(
+                {
+                    "name": f"web-{i}.bench.test",
+                    "domain_mode": "custom",
+                    "project_type": "other",
+                    "root_dir": f"apps/web-{i}",
+                    "certificate": True,
+                    "aliases": [f"www.web-{i}.bench.test"],
+                    "deployment_script": "npm ci\nnpm run build\n",
+                    "processes": [{"name": "web", "command": "npm start"}],
+                    "environment": "NODE_ENV=production\n",
+                }
+            )
+        else:
+            sites.append(
+                {
+                    "name": f"static-{i}",
+                    "project_type": "other",
+                    "clone_repository": False,
+                }
+            )
+
+    return {
+        "organization": "bench",
+        "server": server,
+        "github_repository": "bench/bench",
+        "sites": sites,
+    }
+
+
+def run_main(workspace: Path, api_url: str, extra_env: dict):
+    env = {
+        **os.environ,
+        "GITHUB_WORKSPACE": str(workspace),
+        "DEPLOYMENT_FILE": "forge-deploy.yml",
+        "FORGE_API_TOKEN": "bench-token",
+        "FORGE_API_URL": api_url,
+        "FORGE_API_RATE_LIMIT": "1000000",
+        **extra_env,
+    }
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, str(MAIN_PATH)],
+        env=env,
+        cwd=workspace,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        print(result.stdout[-4000:], file=sys.stderr)
+        raise RuntimeError(f"main.py exited with code {result.returncode}")
+    return elapsed
+
+
+def run_scenario(site_count: int, args) -> dict:
+    forge = FakeForge(
+        servers=["bench"],
+        latency=args.latency,
+        transition_delay=args.transition_delay,
+        page_size=args.page_size,
+    )
+    extra_env = {"MAX_PARALLEL_SITES": str(args.max_parallel_sites)}
+    if args.cache:
+        extra_env["CACHE_DIR"] = ".forge-cache"
+
+    results = {"sites": site_count, "runs": {}}
+    with tempfile.TemporaryDirectory() as workspace, FakeForgeServer(forge) as url:
+        workspace = Path(workspace)
+        with open(workspace / "forge-deploy.yml", "w") as file:
+            yaml.safe_dump(make_config(site_count), file)
+
+        for run_name in ("create", "update"):
+            forge.reset_calls()
+            elapsed = run_main(workspace, url, extra_env)
+            calls = dict(forge.calls.most_common())
+            results["runs"][run_name] = {
+                "wall_time": round(elapsed, 3),
+                "api_calls": sum(calls.values()),
+                "calls_per_endpoint": calls,
+            }
+    return results
+
+
+def print_report(results: list[dict]):
+    print()
+    print(f"{'sites':>6} {'run':<7} {'wall (s)':>9} {'API calls':>10}")
+    for result in results:
+        for run_name, run in result["runs"].items():
+            print(
+                f"{result['sites']:>6} {run_name:<7} {run['wall_time']:>9.2f} {run['api_calls']:>10}"
+            )
+
+    for result in results:
+        for run_name, run in result["runs"].items():
+            print(f"\n{result['sites']} sites, {run_name} run:")
+            for endpoint, count in run["calls_per_endpoint"].items():
+                print(f"  {count:>6}  {endpoint}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sites", default="1,10,50,200")
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--transition-delay", type=float, default=0.1)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--max-parallel-sites", type=int, default=1)
+    parser.add_argument(
+        "--cache", action="store_true", help="keep an API cache between the runs"
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for site_count in [int(n) for n in args.sites.split(",")]:
+        print(f"Running {site_count} site(s)...", flush=True)
+        results.append(run_scenario(site_count, args))
+
+    print_report(results)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,104 @@
+"""
+Startup benchmark: measures, in fresh interpreters, how long it takes to import
+`src/main.py` and to load a synthetic deployment file of each size without a
+config cache, with an empty cache (first run) and with a warm cache.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --sites 1,50 --repeat 10 --json startup.json
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import yaml
+
+from run import make_config
+
+SRC_PATH = Path(__file__).resolve().parent.parent / "src"
+
+# runs in a fresh interpreter, prints the timings as JSON
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {src!r})
+import main
+imported = time.perf_counter()
+from config_cache import ConfigCache, load_config
+cache = ConfigCache({cache_dir!r}) if {cache_dir!r} else None
+load_config({path!r}, None, cache)
+loaded = time.perf_counter()
+print(json.dumps({{"import": imported - start, "load": loaded - imported}}))
+"""
+
+MODES = ("no cache", "cold cache", "warm cache")
+
+
+def probe(path: Path, cache_dir: str | None) -> dict:
+    """Total interpreter time and the import and load times of one fresh process."""
+    code = PROBE.format(src=str(SRC_PATH), path=str(path), cache_dir=cache_dir or "")
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run_scenario(site_count: int, repeat: int) -> dict:
+    timings = {mode: [] for mode in MODES}
+    with tempfile.TemporaryDirectory() as workspace:
+        path = Path(workspace) / "forge-deploy.yml"
+        with open(path, "w") as file:
+            yaml.safe_dump(make_config(site_count), file)
+
+        for i in range(repeat):
+            timings["no cache"].append(probe(path, None))
+            cache_dir = str(Path(workspace) / f"cache-{i}")
+            timings["cold cache"].append(probe(path, cache_dir))
+            timings["warm cache"].append(probe(path, cache_dir))
+
+    return {
+        "sites": site_count,
+        "modes": {
+            mode: {
+                key: round(statistics.median(t[key] for t in runs) * 1000, 1)
+                for key in ("import", "load")
+            }
+            for mode, runs in timings.items()
+        },
+    }
+
+
+def print_report(results: list[dict]):
+    print()
+    print(
+        f"{'sites':>6} {'mode':<11} {'import (ms)':>12} {'load (ms)':>10} {'total':>8}"
+    )
+    for result in results:
+        for mode, times in result["modes"].items():
+            total = times["import"] + times["load"]
+            print(
+                f"{result['sites']:>6} {mode:<11} {times['import']:>12.1f} {times['load']:>10.1f} {total:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sites", default="1,10,50,200")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for site_count in [int(n) for n in args.sites.split(",")]:
+        print(f"Measuring {site_count} site(s)...", flush=True)
+        results.append(run_scenario(site_count, args.repeat))
+
+    print_report(results)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
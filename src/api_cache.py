@@ -0,0 +1,106 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+# how long cached lookups are used without asking Forge, in seconds
+SERVER_TTL = 24 * 3600
+SITES_TTL = 10 * 60
+NGINX_TEMPLATES_TTL = 60 * 60
+
+
+@dataclass
+class CacheEntry:
+    url: str
+    body: dict
+    etag: str | None
+    stored_at: float
+
+    def is_fresh(self, ttl: float) -> bool:
+        return time.time() - self.stored_at < ttl
+
+
+class ApiCache:
+    """
+    On-disk cache of Forge API GET responses, one JSON file per URL, meant to be
+    kept between runs (e.g. with `actions/cache`).
+
+    Entries are used as is while younger than their TTL. Older entries are sent
+    back to Forge with `If-None-Match` when they have an ETag, so an unchanged
+    response costs a `304` instead of the full body. Writes invalidate the
+    entries under the URL they touch.
+
+    Only slow changing, non-sensitive lookups are cached (servers, sites, nginx
+    templates); environments and deployment scripts never are.
+    """
+
+    def __init__(self, directory: str, api_token: str):
+        # entries of different tokens (organizations, permissions) never mix
+        namespace = hashlib.sha256(api_token.encode()).hexdigest()[:16]
+        self.directory = os.path.join(directory, namespace)
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries: dict[str, CacheEntry] = {}
+        self._load()
+
+    def _path(self, url: str) -> str:
+        return os.path.join(
+            self.directory, hashlib.sha256(url.encode()).hexdigest() + ".json"
+        )
+
+    def _load(self):
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), "r") as file:
+                    entry = CacheEntry(**json.load(file))
+            except (OSError, ValueError, TypeError) as e:
+                logger.debug(f"Ignoring unreadable cache entry `{name}`: {e}")
+                continue
+            self._entries[entry.url] = entry
+        logger.debug(f"Loaded {len(self._entries)} cached API response(s)")
+
+    def get(self, url: str) -> CacheEntry | None:
+        with self._lock:
+            return self._entries.get(url)
+
+    def store(self, url: str, body: dict, etag: str | None = None):
+        entry = CacheEntry(url=url, body=body, etag=etag, stored_at=time.time())
+        with self._lock:
+            self._entries[url] = entry
+            self._write(entry)
+
+    def touch(self, url: str):
+        """Mark an entry as fresh again, after Forge confirmed it didn't change."""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry:
+                entry.stored_at = time.time()
+                self._write(entry)
+
+    def invalidate(self, url_prefix: str):
+        """Drop every entry whose URL starts with `url_prefix`."""
+        with self._lock:
+            for url in [u for u in self._entries if u.startswith(url_prefix)]:
+                del self._entries[url]
+                try:
+                    os.remove(self._path(url))
+                except FileNotFoundError:
+                    pass
+
+    def _write(self, entry: CacheEntry):
+        path = self._path(entry.url)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump(entry.__dict__, file)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # the cache is an optimization, never fail the run because of it
+            logger.warning(f"Failed to write API cache entry: {e}")
@@ -0,0 +1,531 @@
+import asyncio
+import json
+from typing import AsyncIterator, Literal
+from urllib.parse import urljoin
+
+import aiohttp
+
+from api_cache import NGINX_TEMPLATES_TTL, SERVER_TTL, SITES_TTL, ApiCache
+from forge_api import FORGE_API_URI, ForgeApiError
+from metrics import Metrics
+from transport import (
+    RateLimitedSession,
+    TokenBucket,
+    TransportStats,
+    backoff_delay,
+    retry_after_delay,
+)
+
+# returned by `_request` when a 404 is an expected answer
+_NOT_FOUND = object()
+
+
+class AsyncForgeApi:
+    """
+    Asyncio twin of `ForgeApi`.
+
+    All requests share one aiohttp session and its connection pool, so many reads
+    and status polls can be awaited together from a single event loop. Requests
+    follow the same rate limiting and retry rules as `RateLimitedSession`; pass the
+    `bucket` of a `ForgeApi` session to share its request budget.
+
+        async with AsyncForgeApi(token, org) as forge_api:
+            sites, daemons = await asyncio.gather(
+                forge_api.get_all_sites(server_id),
+                forge_api.get_server_daemons(server_id),
+            )
+    """
+
+    def __init__(
+        self,
+        api_token,
+        org,
+        pool_size=100,
+        base_uri=FORGE_API_URI,
+        requests_per_minute=60,
+        bucket: TokenBucket | None = None,
+        max_retries=5,
+        cache: ApiCache | None = None,
+        metrics: Metrics | None = None,
+    ):
+        self.forge_uri = f"{base_uri}/orgs/{org}"
+        self.cache = cache
+        self.metrics = metrics
+        self.pool_size = pool_size
+        self.bucket = bucket or TokenBucket(requests_per_minute)
+        self.max_retries = max_retries
+        self.stats = TransportStats()
+        self.headers = {
+            "Authorization": f"Bearer {api_token}",
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        }
+        self.session: aiohttp.ClientSession | None = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+            )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _request(
+        self,
+        method,
+        url,
+        error_message,
+        json_body=None,
+        allow_not_found=False,
+        cache_ttl=None,
+    ):
+        """
+        Send a request and return the decoded JSON body (None if the body is empty).
+        With a `cache_ttl`, GET responses go through the on-disk cache.
+        """
+        entry = self.cache.get(url) if self.cache and cache_ttl else None
+        if entry and entry.is_fresh(cache_ttl):
+            return entry.body
+        headers = {"If-None-Match": entry.etag} if entry and entry.etag else None
+
+        if self.session is None:
+            await self.open()
+
+        start = self.metrics.now() if self.metrics else 0.0
+        bytes_sent = len(json.dumps(json_body)) if json_body is not None else 0
+        retries = 0
+
+        def record(status=None, bytes_received=0):
+            if self.metrics:
+                self.metrics.record_call(
+                    method, url, status, start, bytes_sent, bytes_received, retries
+                )
+
+        while True:
+            waited = self.bucket.reserve()
+            if waited:
+                if self.metrics:
+                    self.metrics.add_span(
+                        "rate limit", "sleep", self.metrics.now(), waited
+                    )
+                await asyncio.sleep(waited)
+            self.stats.requests += 1
+            self.stats.budget_wait += waited
+
+            delay = None
+            try:
+                async with self.session.request(  # type: ignore
+                    method, url, json=json_body, headers=headers
+                ) as response:
+                    status = response.status
+                    if status == 429:
+                        self.stats.throttled += 1
+                    can_retry = retries < self.max_retries and (
+                        status == 429
+                        or (
+                            status in RateLimitedSession.RETRY_STATUSES
+                            and method in RateLimitedSession.RETRY_METHODS
+                        )
+                    )
+                    if can_retry:
+                        delay = retry_after_delay(
+                            response.headers.get("Retry-After")
+                        ) or backoff_delay(retries)
+                        if status == 429:
+                            self.bucket.pause(delay)
+                    elif allow_not_found and status == 404:
+                        record(status)
+                        return _NOT_FOUND
+                    elif entry and status == 304:
+                        record(status)
+                        self.cache.touch(url)
+                        return entry.body
+                    else:
+                        response.raise_for_status()
+                        body = await response.read()
+                        etag = response.headers.get("ETag")
+            except aiohttp.ClientResponseError as e:
+                record(e.status)
+                raise ForgeApiError(error_message, e.status) from e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if (
+                    method not in RateLimitedSession.RETRY_METHODS
+                    or retries >= self.max_retries
+                ):
+                    record()
+                    raise ForgeApiError(error_message) from e
+                delay = backoff_delay(retries)
+
+            if delay is None:
+                record(status, len(body))
+                data = json.loads(body) if body else None
+                if self.cache and cache_ttl:
+                    self.cache.store(url, data, etag)
+                return data
+
+            retries += 1
+            self.stats.retried += 1
+            if self.metrics:
+                self.metrics.add_span(
+                    "retry backoff", "sleep", self.metrics.now(), delay
+                )
+            await asyncio.sleep(delay)
+
+    def _invalidate(self, url_prefix):
+        if self.cache:
+            self.cache.invalidate(url_prefix)
+
+    async def _iter_pages(self, url, error_message, ttl=None) -> AsyncIterator[dict]:
+        """
+        Yield the items of a paginated collection, following the `links.next` of each
+        page. Pages are only fetched when the caller consumes past the previous one.
+        """
+        while url:
+            page = await self._request("GET", url, error_message, cache_ttl=ttl)
+            for item in page["data"]:
+                yield item
+
+            next_url = (page.get("links") or {}).get("next")
+            url = urljoin(url, next_url) if next_url else None
+
+    # --- Servers ---
+    async def get_server_by_name(self, server_name):
+        data = await self._request(
+            "GET",
+            f"{self.forge_uri}/servers?filter[name]={server_name}",
+            "Failed to get server from Laravel Forge API",
+            cache_ttl=SERVER_TTL,
+        )
+        servers = data["data"]
+
+        # Filter returns substring matches, so find exact match
+        exact_matches = [s for s in servers if s["attributes"]["name"] == server_name]
+
+        if len(exact_matches) == 0:
+            raise ForgeApiError(f"Server '{server_name}' not found in Laravel Forge")
+
+        return exact_matches[0]
+
+    # --- Sites ---
+    async def create_site(self, server_id, payload):
+        try:
+            data = await self._request(
+                "POST",
+                f"{self.forge_uri}/servers/{server_id}/sites",
+                "Failed to create site from Laravel Forge API",
+                json_body=payload,
+            )
+        finally:
+            self._invalidate(f"{self.forge_uri}/servers/{server_id}/sites")
+        return data["data"]
+
+    def iter_sites(self, server_id) -> AsyncIterator[dict]:
+        return self._iter_pages(
+            f"{self.forge_uri}/servers/{server_id}/sites",
+            "Failed to get sites from Laravel Forge API",
+            SITES_TTL,
+        )
+
+    async def get_all_sites(self, server_id):
+        return [item async for item in self.iter_sites(server_id)]
+
+    async def get_site_by_id(self, server_id, site_id):
+        data = await self._request(
+            "GET",
+            f"{self.forge_uri}/sites/{site_id}",
+            "Failed to get site from Laravel Forge API",
+        )
+        return data["data"]
+
+    async def update_site(self, server_id, site_id, **kwargs):
+        try:
+            await self._request(
+                "PUT",
+                f"{self.forge_uri}/servers/{server_id}/sites/{site_id}",
+                "Failed to update site from Laravel Forge API",
+                json_body={**kwargs},
+            )
+        finally:
+            self._invalidate(f"{self.forge_uri}/servers/{server_id}/sites")
+
+    async def update_deployment_script(
+        self, server_id, site_id, content, auto_source=False
+    ):
+        data = await self._request(
+            "PUT",
+            f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/deployments/script",
+            "Failed to update deployment script from Laravel Forge API",
+            json_body={
+                "content": content,
+                "auto_source": auto_source,
+            },
+        )
+        return data["data"]
+
+    async def update_site_environment(self, server_id, site_id, content):
+        await self._request(
+            "PUT",
+            f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/environment",
+            "Failed to update site environment from Laravel Forge API",
+            json_body={
+                "environment": content,
+            },
+        )
+
+    async def get_deployment_script(self, server_id, site_id):
+        data = await self._request(
+            "GET",
+            f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/deployments/script",
+            "Failed to get deployment script from Laravel Forge API",
+        )
+        return data["data"]
+
+    async def get_site_environment(self, server_id, site_id):
+        data = await self._request(
+            "GET",
+            f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/environment",
+            "Failed to get site environment from Laravel Forge API",
+        )
+        return data["data"]
+
+    async def deploy_site(self, server_id, site_id):
+        """Trigger a site deployment. Returns the deployment ID."""
+        data = await self._request(
+            "POST",
+            f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/deployments",
+            "Failed to deploy site from Laravel Forge API",
+        )
+        return data["data"]
+
+    async def get_deployment(self, server_id, site_id, deployment_id):
+        """Get the status of a deployment."""
+        data = await self._request(
+            "GET",
+            f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/deployments/{deployment_id}",
+            "Failed to get deployment status from Laravel Forge API",
+        )
+        return data["data"]
+
+    async def get_deployment_log(self, server_id, site_id, deployment_id):
+        """Get the deployment log. Returns None if log doesn't exist (404)."""
+        data = await self._request(
+            "GET",
+            f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/deployments/{deployment_id}/log",
+            "Failed to get deployment log from Laravel Forge API",
+            allow_not_found=True,
+        )
+        return None if data is _NOT_FOUND else data["data"]
+
+    # --- nginx ---
+
+    async def get_nginx_templates_by_name(self, server_id, name) -> dict | None:
+        data = await self._request(
+            "GET",
+            f"{self.forge_uri}/servers/{server_id}/nginx/templates?filter[name]={name}",
+            "Failed to get nginx templates from Laravel Forge API",
+            cache_ttl=NGINX_TEMPLATES_TTL,
+        )
+        templates = data["data"]
+
+        # Filter returns substring matches, so find exact match
+        exact_matches = [t for t in templates if t["attributes"]["name"] == name]
+
+        if len(exact_matches) == 0:
+            return None
+
+        # concurrent runs may have created duplicates, all of them use the oldest
+        return min(exact_matches, key=lambda t: t["id"])
+
+    async def create_nginx_template(self, server_id, name, content):
+        try:
+            data = await self._request(
+                "POST",
+                f"{self.forge_uri}/servers/{server_id}/nginx/templates",
+                "Failed to create nginx template from Laravel Forge API",
+                json_body={
+                    "content": content,
+                    "name": name,
+                },
+            )
+        finally:
+            self._invalidate(f"{self.forge_uri}/servers/{server_id}/nginx/templates")
+        return data["data"]["id"]
+
+    async def get_nginx_config(self, server_id, site_id):
+        data = await self._request(
+            "GET",
+            f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/nginx",
+            "Failed to get nginx config from Laravel Forge API",
+        )
+        return data["data"]
+
+    async def set_nginx_config(self, server_id, site_id, nginx_config):
+        await self._request(
+            "PUT",
+            f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/nginx",
+            "Failed to set nginx config from Laravel Forge API",
+            json_body={"config": nginx_config},
+        )
+
+    # --- Domains ---
+    def iter_site_domains(self, server_id, site_id) -> AsyncIterator[dict]:
+        return self._iter_pages(
+            f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/domains",
+            "Failed to get site domains from Laravel Forge API",
+        )
+
+    async def get_site_domains(self, server_id, site_id):
+        return [item async for item in self.iter_site_domains(server_id, site_id)]
+
+    async def create_site_domain(self, server_id, site_id, domain):
+        data = await self._request(
+            "POST",
+            f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/domains",
+            "Failed to create site domain from Laravel Forge API",
+            json_body={
+                "name": domain,
+                "allow_wildcard_subdomains": False,
+                "www_redirect_type": "none",
+            },
+        )
+        return data["data"]
+
+    async def delete_site_domain(self, server_id, site_id, domain_id):
+        await self._request(
+            "DELETE",
+            f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/domains/{domain_id}",
+            "Failed to delete site domain from Laravel Forge API",
+        )
+
+    async def get_domain_certificate(self, server_id, site_id, domain_id):
+        """Get the certificate for a specific domain. Returns None if not found."""
+        data = await self._request(
+            "GET",
+            f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/domains/{domain_id}/certificate",
+            "Failed to get domain certificate from Laravel Forge API",
+            allow_not_found=True,
+        )
+        return None if data is _NOT_FOUND else data["data"]
+
+    async def create_domain_certificate(self, server_id, site_id, domain_id):
+        """Create a LetsEncrypt certificate for a domain."""
+        data = await self._request(
+            "POST",
+            f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/domains/{domain_id}/certificate",
+            "Failed to create domain certificate from Laravel Forge API",
+            json_body={
+                "type": "letsencrypt",
+                "letsencrypt": {
+                    "verification_method": "http-01",
+                    "key_type": "ecdsa",
+                },
+            },
+        )
+        return data["data"]
+
+    # --- Php ---
+
+    async def get_server_installed_php_versions(self, server_id):
+        data = await self._request(
+            "GET",
+            f"{self.forge_uri}/servers/{server_id}/php/versions",
+            "Failed to get installed PHP versions",
+        )
+        return data["data"]
+
+    async def get_php_version(self, server_id, version):
+        """Get a specific PHP version by filtering. Returns None if not found."""
+        data = await self._request(
+            "GET",
+            f"{self.forge_uri}/servers/{server_id}/php/versions?filter[version]={version}",
+            "Failed to get PHP version",
+        )
+        versions = data["data"]
+        return versions[0] if len(versions) > 0 else None
+
+    async def install_php_version(self, server_id, version):
+        await self._request(
+            "POST",
+            f"{self.forge_uri}/servers/{server_id}/php/versions",
+            "Failed to install PHP version",
+            json_body={"version": version},
+        )
+
+    # --- Daemons ---
+    def iter_server_daemons(self, server_id) -> AsyncIterator[dict]:
+        return self._iter_pages(
+            f"{self.forge_uri}/servers/{server_id}/background-processes",
+            "Failed to get server daemons from Laravel Forge API",
+        )
+
+    async def get_server_daemons(self, server_id):
+        return [item async for item in self.iter_server_daemons(server_id)]
+
+    async def create_daemon(self, server_id, name, command, directory, user="forge"):
+        data = await self._request(
+            "POST",
+            f"{self.forge_uri}/servers/{server_id}/background-processes",
+            "Failed to create daemon from Laravel Forge API",
+            json_body={
+                "name": name,
+                "command": command,
+                "user": user,
+                "directory": directory,
+                "processes": 1,
+            },
+        )
+        return data["data"]
+
+    async def delete_daemon(self, server_id, daemon_id):
+        await self._request(
+            "DELETE",
+            f"{self.forge_uri}/servers/{server_id}/background-processes/{daemon_id}",
+            "Failed to delete daemon from Laravel Forge API",
+        )
+
+    # --- Cron Jobs ---
+    def iter_server_jobs(self, server_id) -> AsyncIterator[dict]:
+        return self._iter_pages(
+            f"{self.forge_uri}/servers/{server_id}/scheduled-jobs",
+            "Failed to get server jobs from Laravel Forge API",
+        )
+
+    async def get_server_jobs(self, server_id):
+        return [item async for item in self.iter_server_jobs(server_id)]
+
+    async def create_job(
+        self,
+        server_id,
+        cmd: str,
+        frequency: Literal["minutely", "hourly", "nightly", "weekly", "monthly"],
+        user="forge",
+    ):
+        data = await self._request(
+            "POST",
+            f"{self.forge_uri}/servers/{server_id}/scheduled-jobs",
+            "Failed to create job from Laravel Forge API",
+            json_body={
+                "user": user,
+                "command": cmd,
+                "frequency": frequency,
+            },
+        )
+        return data["data"]
+
+    async def delete_job(self, server_id, job_id):
+        await self._request(
+            "DELETE",
+            f"{self.forge_uri}/servers/{server_id}/scheduled-jobs/{job_id}",
+            "Failed to delete job from Laravel Forge API",
+        )
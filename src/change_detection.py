@@ -0,0 +1,106 @@
+import fnmatch
+import json
+import logging
+import posixpath
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+# `before` of a push creating a branch
+_NULL_SHA = "0" * 40
+
+
+def event_git_range(event_name: str | None, event_path: str | None) -> str | None:
+    """
+    Git range of the commits of the GitHub event that triggered the run: the pushed
+    commits, or the commits of a pull request since it left its base branch. None
+    for other events and for pushes creating a branch.
+    """
+    if not event_name or not event_path:
+        return None
+    try:
+        with open(event_path, "r") as file:
+            event = json.load(file)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read the GitHub event: {e}")
+        return None
+
+    if event_name == "push":
+        before, after = event.get("before"), event.get("after")
+        if not before or not after or before == _NULL_SHA:
+            return None
+        return f"{before}..{after}"
+    if event_name in ("pull_request", "pull_request_target"):
+        pull_request = event.get("pull_request") or {}
+        base = (pull_request.get("base") or {}).get("sha")
+        head = (pull_request.get("head") or {}).get("sha")
+        if not base or not head:
+            return None
+        return f"{base}...{head}"
+    return None
+
+
+def changed_files(repo_path: str, git_range: str) -> list[str] | None:
+    """Paths changed in `git_range`, both sides of renames. None if git can't tell."""
+    try:
+        result = subprocess.run(
+            ["git", "diff", "--name-only", "--no-renames", git_range, "--"],
+            cwd=repo_path,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        stderr = getattr(e, "stderr", None) or str(e)
+        logger.warning(
+            f"Could not list the files changed in `{git_range}`: {stderr.strip()}. "
+            "Make sure the repository is checked out with enough history "
+            "(`fetch-depth: 0`)."
+        )
+        return None
+    return [line for line in result.stdout.splitlines() if line]
+
+
+def site_watch_paths(site_conf: dict) -> list[str]:
+    """Paths of the repository whose changes affect the site."""
+    paths = [site_conf["root_dir"]]
+    for key in ("env_file", "nginx_custom_config"):
+        if site_conf.get(key):
+            paths.append(site_conf[key])
+    paths.extend(site_conf.get("watch_paths", []))
+    return paths
+
+
+def _normalize(path: str) -> str:
+    return posixpath.normpath(path.lstrip("/"))
+
+
+def path_matches(path: str, watched: str) -> bool:
+    """Whether `path` is `watched`, is inside it, or matches it as a glob pattern."""
+    path, watched = _normalize(path), _normalize(watched)
+    if watched == ".":
+        return True
+    if path == watched or path.startswith(watched + "/"):
+        return True
+    return any(c in watched for c in "*?[") and fnmatch.fnmatchcase(path, watched)
+
+
+def affected_sites(sites: list[dict], changed: list[str], deployment_file: str):
+    """
+    Sites with a changed file in their paths. Every site is affected when the
+    deployment file itself changed, the configuration of any site may have.
+    """
+    if any(_normalize(path) == _normalize(deployment_file) for path in changed):
+        logger.info(f"`{deployment_file}` changed, every site is deployed")
+        return list(sites)
+
+    affected = []
+    for site_conf in sites:
+        watched = site_watch_paths(site_conf)
+        if any(path_matches(path, w) for path in changed for w in watched):
+            affected.append(site_conf)
+        else:
+            logger.info(
+                f"Skipping site `{site_conf['name']}`, none of its files changed"
+            )
+    return affected
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from utils import replace_secrets_and_envs_yaml, validate_yaml_data
+
+logger = logging.getLogger(__name__)
+
+# files whose changes may change how a deployment file is validated or normalized
+_SCHEMA_FILES = [
+    os.path.join(os.path.dirname(__file__), "schema.py"),
+    os.path.join(os.path.dirname(__file__), "validator.py"),
+    os.path.join(os.path.dirname(__file__), "..", "requirements.txt"),  # Cerberus
+]
+# entries not used for this long are removed
+MAX_ENTRY_AGE = 30 * 24 * 3600
+
+
+def schema_version() -> str:
+    """Hash of the schema, of the validator and of the pinned Cerberus version."""
+    digest = hashlib.sha256()
+    for path in _SCHEMA_FILES:
+        try:
+            with open(path, "rb") as file:
+                digest.update(file.read())
+        except OSError:
+            digest.update(path.encode())
+    return digest.hexdigest()
+
+
+class ConfigCache:
+    """
+    On-disk cache of validated and normalized deployment files, keyed by the hash of
+    the file and of the schema version, so an unchanged file skips parsing and
+    validation.
+
+    Entries hold the document before secrets and environment variables are
+    replaced: `${{ secrets.X }}` placeholders are kept as is, and secret values
+    never reach the disk.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = os.path.join(directory, "config")
+        os.makedirs(self.directory, exist_ok=True)
+        self._schema_version = schema_version()
+
+    def key(self, content: bytes) -> str:
+        return hashlib.sha256(self._schema_version.encode() + content).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> dict | None:
+        try:
+            with open(self._path(key), "r") as file:
+                config = json.load(file)
+            os.utime(self._path(key))
+            return config
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.debug(f"Ignoring unreadable config cache entry: {e}")
+            return None
+
+    def store(self, key: str, config: dict):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump(config, file)
+            os.replace(tmp_path, path)
+            self._prune()
+        except OSError as e:
+            # the cache is an optimization, never fail the run because of it
+            logger.warning(f"Failed to write config cache entry: {e}")
+
+    def _prune(self):
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > MAX_ENTRY_AGE:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def _has_placeholder(value) -> bool:
+    if isinstance(value, dict):
+        return any(_has_placeholder(v) for v in value.values())
+    if isinstance(value, list):
+        return any(_has_placeholder(v) for v in value)
+    return isinstance(value, str) and "${{" in value
+
+
+def _coerces_placeholder(data, rules) -> bool:
+    """Whether a placeholder sits in a field the schema coerces, e.g. a path."""
+    if not rules or not _has_placeholder(data):
+        return False
+    if "coerce" in rules:
+        return True
+    nested = rules.get("schema")
+    if isinstance(data, dict) and nested:
+        return any(_coerces_placeholder(v, nested.get(k)) for k, v in data.items())
+    if isinstance(data, list) and nested:
+        return any(_coerces_placeholder(item, nested) for item in data)
+    return False
+
+
+def _placeholders_kept(raw, normalized) -> bool:
+    """Whether every string holding a `${{ ... }}` placeholder went through unchanged."""
+    if isinstance(raw, dict):
+        return isinstance(normalized, dict) and all(
+            key not in normalized or _placeholders_kept(value, normalized[key])
+            for key, value in raw.items()
+        )
+    if isinstance(raw, list):
+        return (
+            isinstance(normalized, list)
+            and len(raw) == len(normalized)
+            and all(_placeholders_kept(r, n) for r, n in zip(raw, normalized))
+        )
+    if isinstance(raw, str) and "${{" in raw:
+        return raw == normalized
+    return True
+
+
+def _validate_template(data) -> dict | None:
+    """
+    Validate the document with its placeholders. Returns None when it can only be
+    validated once they are replaced, e.g. a placeholder in a boolean field or in a
+    path the schema rewrites.
+    """
+    from schema import schema
+
+    if _coerces_placeholder(data, {"schema": schema}):
+        return None
+    try:
+        config = validate_yaml_data(data)
+    except Exception:
+        return None
+    return config if _placeholders_kept(data, config) else None
+
+
+def load_config(path: str, secrets: dict | None, cache: ConfigCache | None = None):
+    """Read, validate and normalize a deployment file, then replace its secrets."""
+    try:
+        with open(path, "rb") as file:
+            content = file.read()
+    except FileNotFoundError as e:
+        raise Exception(f"The configuration file {path} is missing.") from e
+
+    key = cache.key(content) if cache else None
+    config = cache.get(key) if cache else None
+    if config is not None:
+        logger.debug("Using cached validated configuration")
+    else:
+        import yaml
+
+        try:
+            data = yaml.safe_load(content)
+            logger.debug("YAML data: %s", data)
+        except yaml.YAMLError as e:
+            raise Exception(f"Error parsing YAML file: {e}") from e
+
+        config = _validate_template(data) if cache else None
+        if config is None:
+            # placeholders first, then validation of the actual values
+            return validate_yaml_data(_replace_secrets(data, secrets))
+        cache.store(key, config)  # type: ignore
+
+    return _replace_secrets(config, secrets)
+
+
+def _replace_secrets(data, secrets):
+    try:
+        return replace_secrets_and_envs_yaml(data, secrets)
+    except Exception as e:
+        raise Exception(f"Error replacing secrets: {e}") from e
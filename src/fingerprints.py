@@ -0,0 +1,119 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from reconciler import build_environment
+from utils import cat_paths
+
+logger = logging.getLogger(__name__)
+
+# files whose changes may change how a site is provisioned
+_CODE_FILES = [
+    os.path.join(os.path.dirname(__file__), "reconciler.py"),
+    os.path.join(os.path.dirname(__file__), "planner.py"),
+]
+# a site is fully reconciled at least this often, to undo changes made on Forge
+MAX_FINGERPRINT_AGE = 24 * 3600
+
+
+def _file_digest(path: str) -> str:
+    try:
+        with open(path, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+    except OSError:
+        return "missing"
+
+
+def site_fingerprint(
+    site_conf: dict, config: dict, source_repo_path: str, action_dir: str, secrets
+) -> str | None:
+    """
+    Hash of everything provisioning the site depends on: its normalized
+    configuration with secrets replaced, its rendered environment, the files it
+    references and the version of the action. None if it can't be computed.
+    """
+    try:
+        environment = build_environment(site_conf, source_repo_path, secrets)
+    except Exception as e:
+        logger.debug(f"No fingerprint for `{site_conf['domain_name']}`: {e}")
+        return None
+
+    files = {}
+    if site_conf.get("nginx_custom_config"):
+        path = site_conf["nginx_custom_config"]
+        files[path] = _file_digest(cat_paths(source_repo_path, path))
+    if site_conf.get("nginx_template"):
+        name = site_conf["nginx_template"]
+        files[f"template:{name}"] = _file_digest(
+            cat_paths(action_dir, "nginx_templates/", f"{name}.conf")
+        )
+
+    document = {
+        "repository": config["github_repository"],
+        "site": site_conf,
+        "environment": environment,
+        "files": files,
+        "code": [_file_digest(path) for path in _CODE_FILES],
+    }
+    return hashlib.sha256(
+        json.dumps(document, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class FingerprintStore:
+    """
+    State file of the fingerprint of each site at its last successful full
+    reconciliation, meant to be kept between runs (e.g. with `actions/cache`).
+    A site whose fingerprint matches only needs to be deployed.
+    """
+
+    def __init__(self, directory: str, organization: str):
+        self.path = os.path.join(directory, "fingerprints.json")
+        self.organization = organization
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, "r") as file:
+                self._entries = json.load(file)
+        except FileNotFoundError:
+            self._entries = {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable fingerprint file: {e}")
+            self._entries = {}
+
+    def _key(self, server_name: str, domain_name: str) -> str:
+        return f"{self.organization}/{server_name}/{domain_name}"
+
+    def matches(self, server_name: str, domain_name: str, fingerprint: str | None):
+        if fingerprint is None:
+            return False
+        with self._lock:
+            entry = self._entries.get(self._key(server_name, domain_name))
+        return (
+            entry is not None
+            and entry["fingerprint"] == fingerprint
+            and time.time() - entry["reconciled_at"] < MAX_FINGERPRINT_AGE
+        )
+
+    def record(self, server_name: str, domain_name: str, fingerprint: str):
+        with self._lock:
+            self._entries[self._key(server_name, domain_name)] = {
+                "fingerprint": fingerprint,
+                "reconciled_at": time.time(),
+            }
+
+    def forget(self, server_name: str, domain_name: str):
+        with self._lock:
+            self._entries.pop(self._key(server_name, domain_name), None)
+
+    def save(self):
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        try:
+            with self._lock, open(tmp_path, "w") as file:
+                json.dump(self._entries, file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            # the state file is an optimization, never fail the run because of it
+            logger.warning(f"Failed to write the fingerprint file: {e}")
@@ -1,15 +1,54 @@
-from typing import Literal
+from typing import Iterator, Literal
+from urllib.parse import urljoin
 
 import requests
+import requests.adapters
 
+from api_cache import NGINX_TEMPLATES_TTL, SERVER_TTL, SITES_TTL, ApiCache
+from metrics import Metrics
+from transport import RateLimitedSession, TokenBucket
 from utils import format_php_version
 
+FORGE_API_URI = "https://forge.laravel.com/api"
+
+
+class ForgeApiError(Exception):
+    """Raised when a Laravel Forge API call fails."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _status_code(error):
+    response = getattr(error, "response", None)
+    return response.status_code if response is not None else None
+
 
 class ForgeApi:
-    def __init__(self, api_token, org):
-        self.forge_uri = f"https://forge.laravel.com/api/orgs/{org}"
+    def __init__(
+        self,
+        api_token,
+        org,
+        pool_size=10,
+        base_uri=FORGE_API_URI,
+        requests_per_minute=60,
+        bucket: TokenBucket | None = None,
+        cache: ApiCache | None = None,
+        metrics: Metrics | None = None,
+    ):
+        self.forge_uri = f"{base_uri}/orgs/{org}"
+        self.cache = cache
 
-        self.session = requests.sessions.Session()
+        self.session = RateLimitedSession(
+            requests_per_minute, bucket=bucket, metrics=metrics
+        )
+        # keep one connection per concurrent site so parallel sites don't queue on the pool
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=max(pool_size, 10)
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
         self.session.headers.update(
             {
                 "Authorization": f"Bearer {api_token}",
@@ -18,22 +57,60 @@ class ForgeApi:
             }
         )
 
-    # --- Servers ---
-    def get_server_by_name(self, server_name):
+    def _get_cached(self, url, error_message, ttl=None):
+        """
+        GET `url` and return its JSON body. With a `ttl`, the response goes through
+        the on-disk cache.
+        """
+        entry = self.cache.get(url) if self.cache and ttl else None
+        if entry and entry.is_fresh(ttl):
+            return entry.body
+
+        headers = {"If-None-Match": entry.etag} if entry and entry.etag else {}
         try:
-            response = self.session.get(
-                f"{self.forge_uri}/servers?filter[name]={server_name}"
-            )
+            response = self.session.get(url, headers=headers)
             response.raise_for_status()
         except requests.RequestException as e:
-            raise Exception("Failed to get server from Laravel Forge API") from e
-        servers = response.json()["data"]
+            raise ForgeApiError(error_message, _status_code(e)) from e
+
+        if entry and response.status_code == 304:
+            self.cache.touch(url)
+            return entry.body
+
+        body = response.json()
+        if self.cache and ttl:
+            self.cache.store(url, body, response.headers.get("ETag"))
+        return body
+
+    def _invalidate(self, url_prefix):
+        if self.cache:
+            self.cache.invalidate(url_prefix)
+
+    def _iter_pages(self, url, error_message, ttl=None) -> Iterator[dict]:
+        """
+        Yield the items of a paginated collection, following the `links.next` of each
+        page. Pages are only fetched when the caller consumes past the previous one.
+        """
+        while url:
+            page = self._get_cached(url, error_message, ttl)
+            yield from page["data"]
+
+            next_url = (page.get("links") or {}).get("next")
+            url = urljoin(url, next_url) if next_url else None
+
+    # --- Servers ---
+    def get_server_by_name(self, server_name):
+        servers = self._get_cached(
+            f"{self.forge_uri}/servers?filter[name]={server_name}",
+            "Failed to get server from Laravel Forge API",
+            SERVER_TTL,
+        )["data"]
 
         # Filter returns substring matches, so find exact match
         exact_matches = [s for s in servers if s["attributes"]["name"] == server_name]
 
         if len(exact_matches) == 0:
-            raise Exception(f"Server '{server_name}' not found in Laravel Forge")
+            raise ForgeApiError(f"Server '{server_name}' not found in Laravel Forge")
 
         return exact_matches[0]
 
@@ -48,16 +125,21 @@ class ForgeApi:
             return response.json()["data"]
 
         except requests.RequestException as e:
-            raise Exception("Failed to create site from Laravel Forge API") from e
+            raise ForgeApiError(
+                "Failed to create site from Laravel Forge API", _status_code(e)
+            ) from e
+        finally:
+            self._invalidate(f"{self.forge_uri}/servers/{server_id}/sites")
+
+    def iter_sites(self, server_id) -> Iterator[dict]:
+        return self._iter_pages(
+            f"{self.forge_uri}/servers/{server_id}/sites",
+            "Failed to get sites from Laravel Forge API",
+            SITES_TTL,
+        )
 
     def get_all_sites(self, server_id):
-        try:
-            response = self.session.get(f"{self.forge_uri}/servers/{server_id}/sites")
-            response.raise_for_status()
-            sites = response.json()["data"]
-            return sites
-        except requests.RequestException as e:
-            raise Exception("Failed to get sites from Laravel Forge API") from e
+        return list(self.iter_sites(server_id))
 
     def get_site_by_id(self, server_id, site_id):
         try:
@@ -65,7 +147,9 @@ class ForgeApi:
             res.raise_for_status()
             return res.json()["data"]
         except requests.RequestException as e:
-            raise Exception("Failed to get site from Laravel Forge API") from e
+            raise ForgeApiError(
+                "Failed to get site from Laravel Forge API", _status_code(e)
+            ) from e
 
     def update_site(self, server_id, site_id, **kwargs):
         try:
@@ -75,7 +159,11 @@ class ForgeApi:
             )
             response.raise_for_status()
         except requests.RequestException as e:
-            raise Exception("Failed to update site from Laravel Forge API") from e
+            raise ForgeApiError(
+                "Failed to update site from Laravel Forge API", _status_code(e)
+            ) from e
+        finally:
+            self._invalidate(f"{self.forge_uri}/servers/{server_id}/sites")
 
     def update_deployment_script(self, server_id, site_id, content, auto_source=False):
         try:
@@ -89,8 +177,35 @@ class ForgeApi:
             response.raise_for_status()
             return response.json()["data"]
         except requests.RequestException as e:
-            raise Exception(
-                "Failed to update deployment script from Laravel Forge API"
+            raise ForgeApiError(
+                "Failed to update deployment script from Laravel Forge API",
+                _status_code(e),
+            ) from e
+
+    def get_deployment_script(self, server_id, site_id):
+        try:
+            response = self.session.get(
+                f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/deployments/script"
+            )
+            response.raise_for_status()
+            return response.json()["data"]
+        except requests.RequestException as e:
+            raise ForgeApiError(
+                "Failed to get deployment script from Laravel Forge API",
+                _status_code(e),
+            ) from e
+
+    def get_site_environment(self, server_id, site_id):
+        try:
+            response = self.session.get(
+                f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/environment"
+            )
+            response.raise_for_status()
+            return response.json()["data"]
+        except requests.RequestException as e:
+            raise ForgeApiError(
+                "Failed to get site environment from Laravel Forge API",
+                _status_code(e),
             ) from e
 
     def update_site_environment(self, server_id, site_id, content):
@@ -103,8 +218,9 @@ class ForgeApi:
             )
             response.raise_for_status()
         except requests.RequestException as e:
-            raise Exception(
-                "Failed to update site environment from Laravel Forge API"
+            raise ForgeApiError(
+                "Failed to update site environment from Laravel Forge API",
+                _status_code(e),
             ) from e
 
     def deploy_site(self, server_id, site_id):
@@ -116,7 +232,9 @@ class ForgeApi:
             response.raise_for_status()
             return response.json()["data"]
         except requests.RequestException as e:
-            raise Exception("Failed to deploy site from Laravel Forge API") from e
+            raise ForgeApiError(
+                "Failed to deploy site from Laravel Forge API", _status_code(e)
+            ) from e
 
     def get_deployment(self, server_id, site_id, deployment_id):
         """Get the status of a deployment."""
@@ -127,8 +245,9 @@ class ForgeApi:
             response.raise_for_status()
             return response.json()["data"]
         except requests.RequestException as e:
-            raise Exception(
-                "Failed to get deployment status from Laravel Forge API"
+            raise ForgeApiError(
+                "Failed to get deployment status from Laravel Forge API",
+                _status_code(e),
             ) from e
 
     def get_deployment_log(self, server_id, site_id, deployment_id):
@@ -146,31 +265,27 @@ class ForgeApi:
                 and e.response.status_code == 404
             ):
                 return None
-            raise Exception(
-                "Failed to get deployment log from Laravel Forge API"
+            raise ForgeApiError(
+                "Failed to get deployment log from Laravel Forge API", _status_code(e)
             ) from e
 
     # --- nginx ---
 
     def get_nginx_templates_by_name(self, server_id, name) -> dict | None:
-        try:
-            response = self.session.get(
-                f"{self.forge_uri}/servers/{server_id}/nginx/templates?filter[name]={name}"
-            )
-            response.raise_for_status()
-            templates = response.json()["data"]
+        templates = self._get_cached(
+            f"{self.forge_uri}/servers/{server_id}/nginx/templates?filter[name]={name}",
+            "Failed to get nginx templates from Laravel Forge API",
+            NGINX_TEMPLATES_TTL,
+        )["data"]
 
-            # Filter returns substring matches, so find exact match
-            exact_matches = [t for t in templates if t["attributes"]["name"] == name]
+        # Filter returns substring matches, so find exact match
+        exact_matches = [t for t in templates if t["attributes"]["name"] == name]
 
-            if len(exact_matches) == 0:
-                return None
+        if len(exact_matches) == 0:
+            return None
 
-            return exact_matches[0]
-        except requests.RequestException as e:
-            raise Exception(
-                "Failed to get nginx templates from Laravel Forge API"
-            ) from e
+        # concurrent runs may have created duplicates, all of them use the oldest
+        return min(exact_matches, key=lambda t: t["id"])
 
     def create_nginx_template(self, server_id, name, content):
         try:
@@ -184,9 +299,26 @@ class ForgeApi:
             response.raise_for_status()
             return response.json()["data"]["id"]
         except requests.RequestException as e:
-            raise Exception(
-                "Failed to create nginx template from Laravel Forge API"
+            raise ForgeApiError(
+                "Failed to create nginx template from Laravel Forge API",
+                _status_code(e),
+            ) from e
+        finally:
+            self._invalidate(f"{self.forge_uri}/servers/{server_id}/nginx/templates")
+
+    def delete_nginx_template(self, server_id, template_id):
+        try:
+            response = self.session.delete(
+                f"{self.forge_uri}/servers/{server_id}/nginx/templates/{template_id}"
+            )
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise ForgeApiError(
+                "Failed to delete nginx template from Laravel Forge API",
+                _status_code(e),
             ) from e
+        finally:
+            self._invalidate(f"{self.forge_uri}/servers/{server_id}/nginx/templates")
 
     def get_nginx_config(self, server_id, site_id):
         try:
@@ -197,7 +329,9 @@ class ForgeApi:
             return response.json()["data"]
 
         except requests.RequestException as e:
-            raise Exception("Failed to get nginx config from Laravel Forge API") from e
+            raise ForgeApiError(
+                "Failed to get nginx config from Laravel Forge API", _status_code(e)
+            ) from e
 
     def set_nginx_config(self, server_id, site_id, nginx_config):
         try:
@@ -207,18 +341,19 @@ class ForgeApi:
             )
             response.raise_for_status()
         except requests.RequestException as e:
-            raise Exception("Failed to set nginx config from Laravel Forge API") from e
+            raise ForgeApiError(
+                "Failed to set nginx config from Laravel Forge API", _status_code(e)
+            ) from e
 
     # --- Domains ---
+    def iter_site_domains(self, server_id, site_id) -> Iterator[dict]:
+        return self._iter_pages(
+            f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/domains",
+            "Failed to get site domains from Laravel Forge API",
+        )
+
     def get_site_domains(self, server_id, site_id):
-        try:
-            response = self.session.get(
-                f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/domains"
-            )
-            response.raise_for_status()
-            return response.json()["data"]
-        except requests.RequestException as e:
-            raise Exception("Failed to get site domains from Laravel Forge API") from e
+        return list(self.iter_site_domains(server_id, site_id))
 
     def create_site_domain(self, server_id, site_id, domain):
         try:
@@ -233,8 +368,8 @@ class ForgeApi:
             response.raise_for_status()
             return response.json()["data"]
         except requests.RequestException as e:
-            raise Exception(
-                "Failed to create site domain from Laravel Forge API"
+            raise ForgeApiError(
+                "Failed to create site domain from Laravel Forge API", _status_code(e)
             ) from e
 
     def delete_site_domain(self, server_id, site_id, domain_id):
@@ -244,27 +379,8 @@ class ForgeApi:
             )
             response.raise_for_status()
         except requests.RequestException as e:
-            raise Exception(
-                "Failed to delete site domain from Laravel Forge API"
-            ) from e
-
-    def domain_has_certificate(self, server_id, site_id, domain_id):
-        """Check if a domain has a certificate. Returns True if certificate exists, False otherwise."""
-        try:
-            response = self.session.get(
-                f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/domains/{domain_id}/certificate"
-            )
-            response.raise_for_status()
-            return True
-        except requests.RequestException as e:
-            if (
-                hasattr(e, "response")
-                and e.response is not None
-                and e.response.status_code == 404
-            ):
-                return False
-            raise Exception(
-                "Failed to check domain certificate from Laravel Forge API"
+            raise ForgeApiError(
+                "Failed to delete site domain from Laravel Forge API", _status_code(e)
             ) from e
 
     def get_domain_certificate(self, server_id, site_id, domain_id):
@@ -282,8 +398,9 @@ class ForgeApi:
                 and e.response.status_code == 404
             ):
                 return None
-            raise Exception(
-                "Failed to get domain certificate from Laravel Forge API"
+            raise ForgeApiError(
+                "Failed to get domain certificate from Laravel Forge API",
+                _status_code(e),
             ) from e
 
     def create_domain_certificate(self, server_id, site_id, domain_id):
@@ -302,8 +419,9 @@ class ForgeApi:
             response.raise_for_status()
             return response.json()["data"]
         except requests.RequestException as e:
-            raise Exception(
-                "Failed to create domain certificate from Laravel Forge API"
+            raise ForgeApiError(
+                "Failed to create domain certificate from Laravel Forge API",
+                _status_code(e),
             ) from e
 
     # --- Php ---
@@ -314,7 +432,9 @@ class ForgeApi:
             res.raise_for_status()
             return res.json()["data"]
         except requests.RequestException as e:
-            raise Exception("Failed to get installed PHP versions") from e
+            raise ForgeApiError(
+                "Failed to get installed PHP versions", _status_code(e)
+            ) from e
 
     def get_php_version(self, server_id, version):
         """Get a specific PHP version by filtering. Returns None if not found."""
@@ -326,7 +446,7 @@ class ForgeApi:
             versions = res.json()["data"]
             return versions[0] if len(versions) > 0 else None
         except requests.RequestException as e:
-            raise Exception("Failed to get PHP version") from e
+            raise ForgeApiError("Failed to get PHP version", _status_code(e)) from e
 
     def install_php_version(self, server_id, version):
         try:
@@ -336,20 +456,17 @@ class ForgeApi:
             )
             response.raise_for_status()
         except requests.RequestException as e:
-            raise Exception("Failed to install PHP version") from e
+            raise ForgeApiError("Failed to install PHP version", _status_code(e)) from e
 
     # --- Daemons ---
+    def iter_server_daemons(self, server_id) -> Iterator[dict]:
+        return self._iter_pages(
+            f"{self.forge_uri}/servers/{server_id}/background-processes",
+            "Failed to get server daemons from Laravel Forge API",
+        )
+
     def get_server_daemons(self, server_id):
-        try:
-            response = self.session.get(
-                f"{self.forge_uri}/servers/{server_id}/background-processes"
-            )
-            response.raise_for_status()
-            return response.json()["data"]
-        except requests.RequestException as e:
-            raise Exception(
-                "Failed to get server daemons from Laravel Forge API"
-            ) from e
+        return list(self.iter_server_daemons(server_id))
 
     def create_daemon(self, server_id, name, command, directory, user="forge"):
         try:
@@ -366,7 +483,9 @@ class ForgeApi:
             response.raise_for_status()
             return response.json()["data"]
         except requests.RequestException as e:
-            raise Exception("Failed to create daemon from Laravel Forge API") from e
+            raise ForgeApiError(
+                "Failed to create daemon from Laravel Forge API", _status_code(e)
+            ) from e
 
     def delete_daemon(self, server_id, daemon_id):
         try:
@@ -375,19 +494,19 @@ class ForgeApi:
             )
             response.raise_for_status()
         except requests.RequestException as e:
-            raise Exception("Failed to delete daemon from Laravel Forge API") from e
+            raise ForgeApiError(
+                "Failed to delete daemon from Laravel Forge API", _status_code(e)
+            ) from e
 
     # --- Cron Jobs ---
+    def iter_server_jobs(self, server_id) -> Iterator[dict]:
+        return self._iter_pages(
+            f"{self.forge_uri}/servers/{server_id}/scheduled-jobs",
+            "Failed to get server jobs from Laravel Forge API",
+        )
+
     def get_server_jobs(self, server_id):
-        try:
-            # get current schedule job
-            response = self.session.get(
-                f"{self.forge_uri}/servers/{server_id}/scheduled-jobs"
-            )
-            response.raise_for_status()
-            return response.json()["data"]
-        except requests.RequestException as e:
-            raise Exception("Failed to get server jobs from Laravel Forge API") from e
+        return list(self.iter_server_jobs(server_id))
 
     def create_job(
         self,
@@ -406,8 +525,11 @@ class ForgeApi:
                 },
             )
             response.raise_for_status()
+            return response.json()["data"]
         except requests.RequestException as e:
-            raise Exception("Failed to create job from Laravel Forge API") from e
+            raise ForgeApiError(
+                "Failed to create job from Laravel Forge API", _status_code(e)
+            ) from e
 
     def delete_job(self, server_id, job_id):
         try:
@@ -416,4 +538,6 @@ class ForgeApi:
             )
             response.raise_for_status()
         except requests.RequestException as e:
-            raise Exception("Failed to delete job from Laravel Forge API") from e
+            raise ForgeApiError(
+                "Failed to delete job from Laravel Forge API", _status_code(e)
+            ) from e
@@ -1,23 +1,27 @@
+import asyncio
 import copy
 import logging
 import os
 import sys
-from pathlib import Path
+import tempfile
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
 
-import requests
-import yaml
 from dotenv import load_dotenv
 
-from forge_api import ForgeApi
-from utils import (
-    cat_paths,
-    format_php_version,
-    parse_env,
-    replace_nginx_variables,
-    replace_secrets_and_envs_yaml,
-    validate_yaml_data,
-    wait,
-)
+from api_cache import ApiCache
+from change_detection import affected_sites, changed_files, event_git_range
+from config_cache import ConfigCache, load_config
+from metrics import Metrics
+from poller import Poller
+from sharding import parse_shard, site_shard
+from site_logging import SiteLog
+from utils import cat_paths, parse_env
+
+if TYPE_CHECKING:
+    from server_snapshot import ServerSnapshot
 
 load_dotenv()
 
@@ -29,7 +33,27 @@ SOURCE_REPO_PATH = os.getenv(
 )  # represents the path to the repository that triggered the GitHub Action
 DEPLOYMENT_FILE_NAME = os.getenv("DEPLOYMENT_FILE", None)
 FORGE_API_TOKEN = os.getenv("FORGE_API_TOKEN")
+FORGE_API_URL = os.getenv("FORGE_API_URL", None)
 SECRETS_ENV = os.getenv("SECRETS", None)
+MAX_PARALLEL_SITES = os.getenv("MAX_PARALLEL_SITES", None)
+FORGE_API_RATE_LIMIT = os.getenv("FORGE_API_RATE_LIMIT", None)
+DEPLOY_MODE = os.getenv("DEPLOY_MODE") or "apply"  # apply | plan
+CACHE_DIR = os.getenv("CACHE_DIR", None)
+DEPLOYMENT_LOG_DIR = os.getenv("DEPLOYMENT_LOG_DIR") or os.path.join(
+    os.getenv("RUNNER_TEMP") or tempfile.gettempdir(), "forge-deployment-logs"
+)
+METRICS_FILE = os.getenv("METRICS_FILE") or os.path.join(
+    os.getenv("RUNNER_TEMP") or tempfile.gettempdir(), "forge-deploy-metrics.json"
+)
+GITHUB_STEP_SUMMARY = os.getenv("GITHUB_STEP_SUMMARY", None)
+CHANGED_SITES_ONLY = os.getenv("CHANGED_SITES_ONLY", "false").lower() == "true"
+GIT_RANGE = os.getenv("GIT_RANGE", None)
+SHARD = os.getenv("SHARD", None)
+PIPELINED_DEPLOY = os.getenv("PIPELINED_DEPLOY", "false").lower() == "true"
+PROFILE = os.getenv("PROFILE", "false").lower() == "true"
+PROFILE_DIR = os.path.join(
+    os.getenv("RUNNER_TEMP") or tempfile.gettempdir(), "forge-deploy-profile"
+)
 
 logging.basicConfig(
     level=logging.INFO if not DEBUG else logging.DEBUG,
@@ -39,13 +63,26 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def main():
+@dataclass
+class ServerRun:
+    """A server of the deployment file and what is known about it during the run."""
+
+    name: str
+    server_id: int
+    snapshot: "ServerSnapshot"
+    plans: dict = field(default_factory=dict)  # domain name -> SitePlan | Exception
+
+
+def main(metrics: Metrics):
     action_dir = cat_paths(
         os.path.dirname(__file__), "../"
     )  # path of the action directory (parent directory of this file)
     forge_uri = "https://forge.laravel.com/api"
     if FORGE_API_TOKEN is None or FORGE_API_TOKEN == "":
         raise Exception("FORGE_API_TOKEN is not set")
+    if DEPLOY_MODE not in ("apply", "plan"):
+        raise Exception(f"Invalid mode `{DEPLOY_MODE}`, expected `apply` or `plan`")
+    shard = parse_shard(SHARD) if SHARD else None
 
     # Determine deployment file path
     if DEPLOYMENT_FILE_NAME:
@@ -64,603 +101,423 @@ def main():
                 "No deployment file found. Please create either 'forge-deploy.yml' or 'forge-deploy.yaml'"
             )
 
-    try:
-        with open(dep_file_path, "r") as file:
-            data = yaml.safe_load(file)
-            logger.debug("YAML data: %s", data)
-    except FileNotFoundError as e:
-        raise Exception(f"The configuration file {dep_file_path} is missing.") from e
-    except yaml.YAMLError as e:
-        raise Exception(f"Error parsing YAML file: {e}") from e
-
     # replace secrets
     secrets = None
     if SECRETS_ENV:
         secrets = parse_env(SECRETS_ENV)
 
-    try:
-        data: dict = replace_secrets_and_envs_yaml(data, secrets)  # type: ignore
-    except Exception as e:
-        raise Exception(f"Error replacing secrets: {e}") from e
-
-    config = validate_yaml_data(data)
-
-    forge_api = ForgeApi(FORGE_API_TOKEN, config["organization"])
-
-    server = forge_api.get_server_by_name(config["server"])
-    server_id = server.get("id", None)
-
-    if not server_id:
-        raise Exception(f"Server `{config["server"]}` not found")
-
-    # sites
-    server_sites = forge_api.get_all_sites(server_id)
-
-    for site_conf in config["sites"]:
-        print("\n")
-
-        # Compute domain_name based on domain_mode
-        site_conf["domain_name"] = (
-            site_conf["name"]
-            if site_conf["domain_mode"] == "custom"
-            else f"{site_conf['name']}.on-forge.com"
-        )
-
-        # set site gh branch
-        if not site_conf.get("github_branch"):
-            site_conf["github_branch"] = config["github_branch"]
-
-        logger.info(f"\t---- Site: {site_conf['domain_name']} ----")
-
-        existing_site = next(
-            (
-                site
-                for site in server_sites
-                if site["attributes"]["name"] == site_conf["domain_name"]
-            ),
-            None,
+    # an unchanged deployment file is only validated once, the directory is
+    # relative to the repository
+    config_cache = (
+        ConfigCache(cat_paths(SOURCE_REPO_PATH, CACHE_DIR)) if CACHE_DIR else None
+    )
+    with metrics.span("load config", "validate"):
+        config = load_config(dep_file_path, secrets, config_cache)
+
+    if config.get("servers") and config.get("sites"):
+        raise Exception("With `servers`, sites must be listed under their server")
+
+    # a single `server` is a fleet of one
+    servers = config.get("servers") or [
+        {"name": config["server"], "sites": config.get("sites", [])}
+    ]
+
+    # only the sites whose files changed in the triggering commits
+    if CHANGED_SITES_ONLY:
+        git_range = GIT_RANGE or event_git_range(
+            os.getenv("GITHUB_EVENT_NAME"), os.getenv("GITHUB_EVENT_PATH")
         )
-
-        # install site's php version in server
-        if site_conf.get("php_version"):
-            # check if version is installed, if not install it
-            server_php_versions = forge_api.get_server_installed_php_versions(server_id)
-            if format_php_version(site_conf.get("php_version")) not in [
-                php["attributes"]["binary_name"] for php in server_php_versions
-            ]:
-                logger.info(f"Installing php version {site_conf.get('php_version')}...")
-                try:
-                    forge_api.install_php_version(
-                        server_id, site_conf.get("php_version")
-                    )
-
-                    # wait for installation
-                    def until_php_installed():
-                        installed_php = forge_api.get_php_version(
-                            server_id, site_conf.get("php_version")
-                        )
-                        if not installed_php:
-                            raise Exception("Php version not found after installation")
-                        return installed_php["attributes"]["status"] == "installed"
-
-                    if not wait(until_php_installed):
-                        raise Exception("Php installation timed out")
-                except Exception as e:
-                    raise Exception(f"Failed to install php version: {e}") from e
-
-                logger.info(f"Php version {site_conf.get('php_version')} installed")
-
-        # create site
-        if not existing_site:
-            # nginx template
-
-            nginx_template_id = None
-            if site_conf.get("nginx_template"):
-                nginx_templates = forge_api.get_nginx_templates_by_name(
-                    server_id, site_conf["nginx_template"]
-                )
-                nginx_template_id = (
-                    nginx_templates.get("id") if nginx_templates else None
-                )
-
-                # if template isn't added in the server add it from nginx-templates folder
-                if not nginx_template_id:
-                    nginx_template_path = cat_paths(
-                        action_dir,
-                        "nginx_templates/",
-                        f"{site_conf['nginx_template']}.conf",
-                    )
-                    logger.info("Nginx template not created in the server")
-                    logger.info("Creating nginx template...")
-                    if os.path.exists(nginx_template_path):
-                        with open(
-                            nginx_template_path,
-                            "r",
-                        ) as file:
-                            nginx_template_id = forge_api.create_nginx_template(
-                                server_id, site_conf["nginx_template"], file.read()
-                            )
-                            logger.info("Nginx template created successfully")
-                    else:
-                        raise Exception("Invalid nginx template name")
-
-            # Normalize shared paths to have both 'from' and 'to'
-            # TODO: if forge adds a way to update shared paths after site creation implement it
-            shared_paths_normalized = []
-            for path in site_conf["shared_paths"]:
-                if isinstance(path, str):
-                    # String format: use same path for both from and to
-                    shared_paths_normalized.append({"from": path, "to": path})
-                elif isinstance(path, dict):
-                    # Dict format: already has from and to
-                    shared_paths_normalized.append(
-                        {"from": path["from"], "to": path["to"]}
-                    )
-
-            create_site_payload = {
-                "name": site_conf["name"],
-                "domain_mode": site_conf["domain_mode"],
-                "www_redirect_type": site_conf["www_redirect_type"],
-                "allow_wildcard_subdomains": False,
-                "type": site_conf["project_type"],
-                "root_directory": site_conf["root_dir"],
-                "web_directory": site_conf["web_dir"],
-                "is_isolated": site_conf["isolated"],
-                "isolated_user": site_conf.get("isolated_user"),
-                "nginx_template_id": nginx_template_id,
-                "push_to_deploy": False,
-                "php_version": site_conf.get("php_version"),
-                "zero_downtime_deployments": site_conf["zero_downtime_deployments"],
-                "shared_paths": (
-                    shared_paths_normalized
-                    if len(shared_paths_normalized) > 0
-                    else None
-                ),
-            }
-
-            create_site_payload = {
-                k: v for k, v in create_site_payload.items() if v is not None
-            }  # Remove None values
-
-            # add repository
-            if site_conf["clone_repository"]:
-
-                create_site_payload["source_control_provider"] = "github"
-                create_site_payload["repository"] = config["github_repository"]
-                create_site_payload["branch"] = site_conf["github_branch"]
-                create_site_payload["install_composer_dependencies"] = site_conf[
-                    "install_composer_dependencies"
-                ]
-
-            # create site
-            logger.info("Creating site...")
-            existing_site = forge_api.create_site(server_id, create_site_payload)
-
-            def until_site_installed():
-                site = forge_api.get_site_by_id(server_id, existing_site["id"])
-                return site["attributes"]["status"] == "installed" and (
-                    not site_conf["clone_repository"]
-                    or site["attributes"]["repository"]["status"] == "installed"
-                )
-
-            if not wait(until_site_installed):
-                raise Exception("Adding repository timed out")
-
-            logger.info("Site created successfully")
-
-            # set site nginx variables
-            try:
-                nginx_config = forge_api.get_nginx_config(
-                    server_id, existing_site["id"]
-                )["attributes"]["content"]
-                nginx_config = replace_nginx_variables(
-                    nginx_config, site_conf["nginx_template_variables"]
-                )
-                forge_api.set_nginx_config(server_id, existing_site["id"], nginx_config)
-            except Exception as e:
-                raise Exception(f"Failed to set nginx config variables: {e}") from e
-
+        changed = changed_files(SOURCE_REPO_PATH, git_range) if git_range else None
+        if changed is None:
+            logger.info("No git range to compare, every site is deployed")
         else:
-            logger.info("Site already exists")
-            update_payload = {}
-            if (
-                existing_site["attributes"]["repository"]["branch"]
-                != site_conf["github_branch"]
-            ):
-                update_payload["repository_branch"] = site_conf["github_branch"]
-                logger.info("Updating site branch ...")
-
-            if existing_site["attributes"]["quick_deploy"] == True:
-                update_payload["push_to_deploy"] = False
-                logger.info("Disabling quick deploy ...")
-
-            if update_payload:
-                forge_api.update_site(server_id, existing_site["id"], **update_payload)
-                logger.info("Site updated successfully")
-
-        site_id = existing_site["id"]
-        logger.debug(f"Site: %s", existing_site)
-
-        # ---- update aliases ----
-        try:
-            # TODO: change aliases to extra_domains (or smtng like that) and add www redirect type option
-            existing_domains = forge_api.get_site_domains(server_id, site_id)
-            existing_domains_list = [
-                domain["attributes"]["name"]
-                for domain in existing_domains
-                if domain["attributes"]["type"] != "primary"
-            ]
-            config_aliases = site_conf["aliases"]
-
-            # If aliases are not the same, sync them
-            if set(existing_domains_list) != set(config_aliases):
-                # Delete domains that exist in site but not in config
-                for domain in existing_domains:
-                    domain_name = domain["attributes"]["name"]
-                    if (
-                        domain["attributes"]["type"] != "primary"
-                        and domain_name not in config_aliases
-                    ):
-                        forge_api.delete_site_domain(server_id, site_id, domain["id"])
-                        logger.info(f"Domain '{domain_name}' deleted from site.")
-
-                # Create domains that exist in config but not in site
-                for alias in config_aliases:
-                    if alias not in existing_domains_list:
-                        forge_api.create_site_domain(server_id, site_id, alias)
-                        logger.info(f"Domain '{alias}' added to site.")
-
-                logger.info("Site aliases configured successfully.")
-
-        except Exception as e:
-            raise Exception("Error updating aliases.") from e
-
-        # ---- nginx custom config ----
-
-        try:
-            if site_conf.get("nginx_custom_config"):
-                nginx_custom_file_path = cat_paths(
-                    SOURCE_REPO_PATH, site_conf.get("nginx_custom_config")
+            logger.info(f"{len(changed)} file(s) changed in `{git_range}`")
+            deployment_file = os.path.relpath(dep_file_path, SOURCE_REPO_PATH)
+            for server_conf in servers:
+                server_conf["sites"] = affected_sites(
+                    server_conf["sites"], changed, deployment_file
                 )
-                with open(nginx_custom_file_path, "r") as file:
-                    nginx_custom_content = file.read()
+            servers = [s for s in servers if s["sites"]]
+            if not servers:
+                logger.info("No site is affected by the changes, nothing to deploy")
+                return
+
+    # the action input takes precedence over the deployment file, by default each
+    # server reconciles one site at a time
+    max_parallel_sites = (
+        int(MAX_PARALLEL_SITES)
+        if MAX_PARALLEL_SITES
+        else config.get("max_parallel_sites") or len(servers)
+    )
+    if max_parallel_sites < 1:
+        raise Exception("max_parallel_sites must be at least 1")
+
+    # lookups kept between runs, the directory is relative to the repository
+    api_cache = (
+        ApiCache(cat_paths(SOURCE_REPO_PATH, CACHE_DIR), FORGE_API_TOKEN)
+        if CACHE_DIR
+        else None
+    )
+
+    metrics_file = cat_paths(SOURCE_REPO_PATH, METRICS_FILE)
 
-                logger.debug(
-                    f"Nginx custom config file content:\n{nginx_custom_content}"
-                )
-                # compare existing site nginx config and the one in the file if different update
-                site_existing_nginx_config = forge_api.get_nginx_config(
-                    server_id, site_id
-                )["attributes"]["content"]
-                if site_existing_nginx_config != nginx_custom_content:
-                    forge_api.set_nginx_config(server_id, site_id, nginx_custom_content)
-                    logger.info(f"Nginx config updated.")
-        except FileNotFoundError as e:
-            raise Exception(
-                f"Nginx config file `{site_conf.get('nginx_custom_config')} doesn't exist."
-            ) from e
-        except Exception as e:
-            raise Exception("Error when trying to set custom nginx config") from e
-
-        # ---- php version ----
-
-        try:
-            site_php_version = (
-                forge_api.get_site_by_id(server_id, site_id)["attributes"][
-                    "php_version"
-                ]
-                .replace("PHP ", "php")
-                .replace(".", "")
-            )
-
-        except Exception as e:
-            raise Exception("Failed to get site php version") from e
-
-        if (
-            site_conf.get("php_version")
-            and site_conf.get("php_version") != site_php_version
-        ):
-            # update site php version
-            logger.debug(
-                f"php version changed from {site_php_version} to {site_conf.get('php_version')}, updating..."
-            )
-            forge_api.update_site(
-                server_id, site_id, php_version=site_conf.get("php_version")
+    # sites
+    for server_conf in servers:
+        for site_conf in server_conf["sites"]:
+            # Compute domain_name based on domain_mode
+            site_conf["domain_name"] = (
+                site_conf["name"]
+                if site_conf["domain_mode"] == "custom"
+                else f"{site_conf['name']}.on-forge.com"
             )
-            logger.info(f"Php version set to {site_conf.get('php_version')}")
-
-        site_user = site_conf.get("isolated_user") if site_conf["isolated"] else "forge"
-        site_dir = cat_paths(
-            f"/home/{site_user}/",
-            site_conf["domain_name"],
-            "current/" if site_conf["zero_downtime_deployments"] else ".",
-            site_conf["root_dir"],
-        )
-
-        # create daemons
-        try:
-            daemon_ids = []
-            # get existing site daemons
-            server_daemons = forge_api.get_server_daemons(server_id)
-            # existing site daemons
-            site_daemons = [
-                daemon
-                for daemon in server_daemons
-                if Path(daemon["attributes"]["directory"]).resolve()
-                == Path(site_dir).resolve()
-            ]
-            # delete daemon if not in the config
-            for dm in site_daemons:
-                if dm["attributes"]["command"] not in [
-                    daemon["command"] for daemon in site_conf["processes"]
-                ]:
-                    forge_api.delete_daemon(server_id, dm["id"])
-                    logger.info(
-                        f"Daemon-{dm['id']} `{dm["attributes"]['command']}` deleted."
-                    )
-                else:
-                    daemon_ids.append(dm["id"])
-
-            # add new daemons
-            for process in site_conf["processes"]:
-                if process["command"] not in [
-                    dm["attributes"]["command"] for dm in site_daemons
-                ]:
-                    new_daemon = forge_api.create_daemon(
-                        server_id,
-                        process["name"],
-                        process["command"],
-                        site_dir,
-                        user=site_user,
-                    )
-                    daemon_ids.append(new_daemon["id"])
-                    logger.info(
-                        f"Daemon-{new_daemon['id']} `{new_daemon['attributes']['command']}` created."
-                    )
-        except Exception as e:
-            raise Exception(f"Failed to add daemons: {e}") from e
-
-        # ----------Scheduler----------
-        if site_conf["project_type"] == "laravel":
-            try:
-                scheduler_php_version = (
-                    forge_api.get_site_by_id(server_id, site_id)["attributes"][
-                        "php_version"
-                    ]
-                    .replace("PHP", "php")
-                    .replace(" ", "")
-                )
-
-                scheduler_cmd = (
-                    f"{scheduler_php_version} {site_dir}/artisan schedule:run"
-                )
 
-                server_jobs = forge_api.get_server_jobs(server_id)
-                current_scheduler_job = next(
-                    (
-                        job
-                        for job in server_jobs
-                        if job["attributes"]["command"] == scheduler_cmd
-                    ),
-                    None,
+            # set site gh branch
+            if not site_conf.get("github_branch"):
+                site_conf["github_branch"] = (
+                    server_conf.get("github_branch") or config["github_branch"]
                 )
 
-                if site_conf["laravel_scheduler"] and not current_scheduler_job:
-                    forge_api.create_job(server_id, scheduler_cmd, "minutely")
-                    logger.info("Scheduler job created successfully")
-                elif not site_conf["laravel_scheduler"] and current_scheduler_job:
-                    forge_api.delete_job(server_id, current_scheduler_job["id"])
-                    logger.info("Scheduler job deleted successfully")
-
-            except Exception as e:
-                raise Exception(f"Failed to configure laravel scheduler: {e}") from e
-
-        # deployment script
-        # if deployment_script not provided, the default deployment script generated by forge is kept
-        if site_conf.get("deployment_script"):
-            deployment_script = f"# Generated by deployment action, do not modify\n"
-
-            if not site_conf["zero_downtime_deployments"]:
-                deployment_script += (
-                    f"cd {site_dir}\n"
-                    + "git fetch --prune --tags origin\n"
-                    + 'git reset --hard "origin/$FORGE_SITE_BRANCH"\n'
-                )
-            else:
-                deployment_script += (
-                    "$CREATE_RELEASE()\n"
-                    + "cd $FORGE_RELEASE_DIRECTORY\n"
-                    + (
-                        f"cd {site_conf["root_dir"]}\n"
-                        if site_conf["root_dir"] != "."
-                        else ""
+    # this job's share of the sites, when the run is split across jobs
+    if shard:
+        index, count = shard
+        for server_conf in servers:
+            server_conf["sites"] = [
+                s
+                for s in server_conf["sites"]
+                if site_shard(s["domain_name"], count) == index
+            ]
+        servers = [s for s in servers if s["sites"]]
+        logger.info(
+            f"Shard {index}/{count}: {sum(len(s['sites']) for s in servers)} site(s)"
+        )
+        if not servers:
+            logger.info("No site in this shard, nothing to deploy")
+            return
+
+    # the API client and the reconciler are only loaded when there are sites
+    from fingerprints import FingerprintStore, site_fingerprint
+    from forge_api import FORGE_API_URI, ForgeApi
+    from planner import deploy_only_plan, format_plan, plan_site, read_server_state
+    from reconciler import SiteReconciler
+    from server_snapshot import ServerSnapshot
+
+    # one connection pool and request budget for every server
+    forge_api = ForgeApi(
+        FORGE_API_TOKEN,
+        config["organization"],
+        pool_size=max_parallel_sites * SiteReconciler.MAX_PARALLEL_PHASES,
+        base_uri=FORGE_API_URL or FORGE_API_URI,
+        requests_per_minute=int(FORGE_API_RATE_LIMIT or 60),
+        cache=api_cache,
+        metrics=metrics,
+    )
+
+    # fingerprint of each site at its last full reconciliation, sites whose
+    # fingerprint didn't change are only deployed
+    fingerprint_store = (
+        FingerprintStore(cat_paths(SOURCE_REPO_PATH, CACHE_DIR), config["organization"])
+        if CACHE_DIR and DEPLOY_MODE == "apply"
+        else None
+    )
+
+    fingerprints = {}  # (server name, domain name) -> fingerprint
+    deploy_only = set()  # (server name, domain name) of the unchanged sites
+    if fingerprint_store:
+        with metrics.span("fingerprint sites", "validate"):
+            for server_conf in servers:
+                for site_conf in server_conf["sites"]:
+                    key = (server_conf["name"], site_conf["domain_name"])
+                    fingerprints[key] = site_fingerprint(
+                        site_conf, config, SOURCE_REPO_PATH, action_dir, secrets
                     )
-                )
-
-            deployment_script += site_conf.get("deployment_script") + "\n"
-
-            if site_conf["zero_downtime_deployments"]:
-                deployment_script += "$ACTIVATE_RELEASE()\n"
-                if site_conf["project_type"] == "laravel":
-                    deployment_script += f"$RESTART_QUEUES()\n"
-
-            for d_id in daemon_ids:
-                deployment_script += f"sudo supervisorctl restart daemon-{d_id}:*\n"
-
-            try:
-                forge_api.update_deployment_script(
+                    if fingerprint_store.matches(*key, fingerprints[key]):
+                        deploy_only.add(key)
+
+    # read the current state of the servers with batched requests
+    async def read_states(servers_to_read):
+        from async_forge_api import AsyncForgeApi
+
+        async with AsyncForgeApi(
+            FORGE_API_TOKEN,
+            config["organization"],
+            base_uri=FORGE_API_URL or FORGE_API_URI,
+            bucket=forge_api.session.bucket,
+            cache=api_cache,
+            metrics=metrics,
+        ) as async_api:
+
+            async def read_server(server_conf):
+                server = await async_api.get_server_by_name(server_conf["name"])
+                server_id = server.get("id", None)
+                if not server_id:
+                    raise Exception(f"Server `{server_conf['name']}` not found")
+                # unchanged sites are only deployed, their state isn't needed
+                state = await read_server_state(
+                    async_api,
                     server_id,
-                    site_id,
-                    deployment_script,
-                    auto_source=False,
+                    [
+                        s
+                        for s in server_conf["sites"]
+                        if (server_conf["name"], s["domain_name"]) not in deploy_only
+                    ],
                 )
-            except Exception as e:
-                raise Exception(f"Failed to add deployment script: {e}") from e
-
-            logger.info("Deployment script added successfully")
-
-        # set env
-        try:
-            site_env = {}
-            # read env file
-            if site_conf.get("env_file"):
-                env_file_path = cat_paths(SOURCE_REPO_PATH, site_conf.get("env_file"))
-                try:
-                    with open(env_file_path, "r") as file:
-                        logger.info(
-                            "Loading environment variables from file `%s`",
-                            site_conf.get("env_file"),
-                        )
-                        env_file_content = file.read()
-                        logger.debug("Env file content:\n%s", env_file_content)
-                        # replace screts
-                        env_file_content = str(
-                            replace_secrets_and_envs_yaml(env_file_content, secrets)
-                        )
-                        # parse env
-                        file_env = parse_env(env_file_content)
-                        site_env.update(file_env)
-                except FileNotFoundError as e:
-                    raise Exception(
-                        f"Environment file `{site_conf.get('env_file')}` not found"
-                    ) from e
-
-            if site_conf.get("environment"):
-                config_env = parse_env(site_conf.get("environment"))
-                site_env.update(config_env)
-
-            env_str = "# Generated by deployment action, do not modify\n" + "\n".join(
-                [f"{k}={v}" for k, v in site_env.items()]
+                return server_id, state
+
+            states = await asyncio.gather(*[read_server(s) for s in servers_to_read])
+            return states, async_api.stats
+
+    def unchanged_server(server_conf):
+        """
+        Server id and snapshot of a server whose sites are all unchanged, without
+        reading its state: the snapshot fetches collections when a site needs
+        them. None if one of its sites was deleted from Forge since the last run.
+        """
+        server = forge_api.get_server_by_name(server_conf["name"])
+        snapshot = ServerSnapshot(forge_api, server["id"])
+        missing = [
+            site_conf
+            for site_conf in server_conf["sites"]
+            if snapshot.site(site_conf["domain_name"]) is None
+        ]
+        for site_conf in missing:
+            deploy_only.discard((server_conf["name"], site_conf["domain_name"]))
+        return None if missing else (server["id"], snapshot)
+
+    read_stats = None
+    with metrics.phase("read servers"):
+        unread = {}  # server name -> (server id, snapshot)
+        for server_conf in servers:
+            if all(
+                (server_conf["name"], s["domain_name"]) in deploy_only
+                for s in server_conf["sites"]
+            ):
+                unread_server = unchanged_server(server_conf)
+                if unread_server:
+                    unread[server_conf["name"]] = unread_server
+
+        states = {}  # server name -> (server id, ServerState)
+        servers_to_read = [s for s in servers if s["name"] not in unread]
+        if servers_to_read:
+            # the reads have their own client, their requests are counted apart
+            read, read_stats = asyncio.run(read_states(servers_to_read))
+            states = {s["name"]: r for s, r in zip(servers_to_read, read)}
+
+    def site_label(run, site_conf):
+        if len(servers) == 1:
+            return site_conf["domain_name"]
+        return f"{run.name}/{site_conf['domain_name']}"
+
+    runs = []
+    for server_conf in servers:
+        if server_conf["name"] in unread:
+            server_id, snapshot = unread[server_conf["name"]]
+            state = None
+        else:
+            server_id, state = states[server_conf["name"]]
+            # server-wide collections, fetched once and shared by all sites of the server
+            snapshot = ServerSnapshot(forge_api, server_id)
+            snapshot.seed(
+                sites=state.sites,
+                php_versions=state.php_versions,
+                daemons=state.daemons,
+                jobs=state.jobs,
+                nginx_templates=state.nginx_templates,
             )
-            if len(env_str) > 0:
-                forge_api.update_site_environment(server_id, site_id, env_str)
-                logger.info("Environment variables set successfully")
-
-        except Exception as e:
-            raise Exception(f"Failed to set environment variables: {e}") from e
-
-        # certificate
-        try:
-            if site_conf["certificate"]:
-                # Get all site domains
-                all_domains = forge_api.get_site_domains(server_id, site_id)
-
-                # Filter out on-forge.com domains
-                domains_to_certify = [
-                    domain
-                    for domain in all_domains
-                    if not domain["attributes"]["name"].endswith(".on-forge.com")
-                ]
-
-                # For each domain, check if certificate exists and create if needed
-                for domain in domains_to_certify:
-                    domain_id = domain["id"]
-                    domain_name = domain["attributes"]["name"]
-
-                    # Check if domain has a certificate
-                    if not forge_api.domain_has_certificate(
-                        server_id, site_id, domain_id
-                    ):
-                        logger.info(
-                            f"Installing certificate for domain '{domain_name}'..."
-                        )
-
-                        # Create certificate
-                        cert = forge_api.create_domain_certificate(
-                            server_id, site_id, domain_id
-                        )
-
-                        # Wait for certificate to be installed
-                        def until_cert_installed():
-                            domain_cert = forge_api.get_domain_certificate(
-                                server_id, site_id, domain_id
-                            )
-                            if not domain_cert:
-                                return True  # certificate failed
-                            return domain_cert["attributes"]["status"] == "installed"
-
-                        if not wait(until_cert_installed):
-                            raise Exception(
-                                f"Certificate installation timed out for domain '{domain_name}'"
-                            )
-
-                        cert = forge_api.get_domain_certificate(
-                            server_id, site_id, domain_id
-                        )
-                        if cert:
-                            logger.info(
-                                f"Certificate installed for domain '{domain_name}'"
-                            )
-                        else:
-                            raise Exception(
-                                f"Certificate installation failed for domain '{domain_name}'"
-                            )
-                    else:
-                        logger.info(
-                            f"Certificate already exists for domain '{domain_name}'"
+        run = ServerRun(server_conf["name"], server_id, snapshot)
+        for site_conf in server_conf["sites"]:
+            with metrics.site(site_label(run, site_conf)), metrics.span("plan", "plan"):
+                try:
+                    key = (run.name, site_conf["domain_name"])
+                    plan = None
+                    if key in deploy_only:
+                        plan = deploy_only_plan(
+                            site_conf, snapshot.site(site_conf["domain_name"])
                         )
+                    if plan is None:
+                        # changed, or deleted from Forge since the last run
+                        deploy_only.discard(key)
+                        plan = plan_site(site_conf, state, SOURCE_REPO_PATH, secrets)
+                    run.plans[site_conf["domain_name"]] = plan
+                except Exception as e:
+                    run.plans[site_conf["domain_name"]] = e
+        runs.append(run)
 
-        except Exception as e:
-            raise Exception(f"Failed to manage certificates: {e}") from e
-
-        # deploy site
-        if site_conf["clone_repository"]:
-            logger.info("Deploying site...")
-
-            # Trigger deployment and get deployment ID
-            deployment_id = forge_api.deploy_site(server_id, site_id)["id"]
-            logger.debug(f"Deployment ID: {deployment_id}")
-
-            # Wait until deployment is finished
-            def until_deployment_finished():
-                status_data = forge_api.get_deployment(
-                    server_id, site_id, deployment_id
-                )
-                status = status_data["attributes"]["status"]
-                logger.debug(f"Deployment status: {status}")
-
-                # Check for failed states
-                if status in ["cancelled", "failed", "failed-build"]:
-                    return True
-
-                # Check for success
-                if status == "finished":
-                    return True
-
-                # Still in progress
-                return False
+    for run in runs:
+        site_plans = [p for p in run.plans.values() if not isinstance(p, Exception)]
+        if len(runs) == 1:
+            logger.info("Plan:\n%s", format_plan(site_plans))
+        else:
+            logger.info(f"Plan for server `{run.name}`:\n%s", format_plan(site_plans))
+
+    # sites of every server, interleaved so that the servers progress together
+    site_jobs = []
+    for position in range(max(len(s["sites"]) for s in servers)):
+        for run, server_conf in zip(runs, servers):
+            if position < len(server_conf["sites"]):
+                site_jobs.append((run, server_conf["sites"][position]))
+
+    if DEPLOY_MODE == "plan":
+        plan_errors = {
+            site_label(run, site_conf): run.plans[site_conf["domain_name"]]
+            for run, site_conf in site_jobs
+            if isinstance(run.plans[site_conf["domain_name"]], Exception)
+        }
+        metrics.write_report(metrics_file, GITHUB_STEP_SUMMARY)
+        for label, error in plan_errors.items():
+            logger.error(f"Failed to plan site `{label}`: {error}")
+        if plan_errors:
+            raise Exception(f"Failed to plan {len(plan_errors)} site(s)")
+        return
+
+    # deployments waited for together print their logs at the same time
+    buffered_logs = max_parallel_sites > 1 or PIPELINED_DEPLOY
+    # pending php installs, sites, certificates and deployments of every site
+    poller = Poller(metrics=metrics)
+    try:
+        # start the missing php versions of every server up front, sites only wait for
+        # them at the steps needing php
+        for run, server_conf in zip(runs, servers):
+            versions = {
+                s["php_version"] for s in server_conf["sites"] if s.get("php_version")
+            }
+            for version in sorted(versions):
+                if not run.snapshot.has_php_version(version):
+                    logger.info(f"Installing php version {version} on `{run.name}`...")
+                run.snapshot.php_version_ready(version, poller)
 
-            if not wait(until_deployment_finished, max_retries=-1):
-                raise Exception("Deployment status check timed out")
+        site_logs = {}  # site job position -> SiteLog
+        reconcilers = {}  # site job position -> SiteReconciler, deployed afterwards
 
-            # Get final status
-            final_status_data = forge_api.get_deployment(
-                server_id, site_id, deployment_id
+        def fail_site(position, error):
+            site_logs[position].logger.error(
+                "An error occurred:\n %s", error, exc_info=True
             )
-            final_status = final_status_data["attributes"]["status"]
-
-            # Get deployment log (always show it)
-            deployment_log = forge_api.get_deployment_log(
-                server_id, site_id, deployment_id
-            )["attributes"]["output"]
-            if deployment_log:
-                logger.info("Deployment log:\n%s", deployment_log)
-            else:
-                logger.warning("Deployment log not available")
-
-            # Check if deployment failed
-            if final_status in ["cancelled", "failed", "failed-build"]:
-                raise Exception(f"Deployment failed with status: {final_status}")
-
-            logger.info("Site deployed successfully")
+            return error
+
+        def reconcile_site(position):
+            run, site_conf = site_jobs[position]
+            label = site_label(run, site_conf)
+            site_log = SiteLog(label, buffered=buffered_logs)
+            site_logs[position] = site_log
+            with metrics.site(label):
+                try:
+                    if not buffered_logs:
+                        print("\n")
+                    site_log.logger.info(f"\t---- Site: {label} ----")
+
+                    plan = run.plans[site_conf["domain_name"]]
+                    if isinstance(plan, Exception):
+                        raise plan
+
+                    reconcilers[position] = SiteReconciler(
+                        forge_api,
+                        run.server_id,
+                        run.snapshot,
+                        poller,
+                        site_conf,
+                        config,
+                        secrets,
+                        action_dir,
+                        SOURCE_REPO_PATH,
+                        site_log.logger,
+                        cat_paths(SOURCE_REPO_PATH, DEPLOYMENT_LOG_DIR),
+                        metrics,
+                    )
+                    reconcilers[position].run(plan, deploy=not PIPELINED_DEPLOY)
+                    return None
+                except Exception as e:
+                    return fail_site(position, e)
+                finally:
+                    site_log.flush()
+
+        # one pool for every server, `max_parallel_sites` caps the whole run
+        with ThreadPoolExecutor(max_workers=max_parallel_sites) as executor:
+            errors = list(executor.map(reconcile_site, range(len(site_jobs))))
+
+        # every site is reconciled first, then the deployments are started back to
+        # back and polled together, so the run waits for the slowest one only
+        if PIPELINED_DEPLOY:
+            # status future -> (site job position, deployment, start)
+            deployments = {}
+            for position, (run, site_conf) in enumerate(site_jobs):
+                if errors[position] is not None:
+                    continue
+                start = metrics.now()
+                with metrics.site(site_label(run, site_conf)):
+                    try:
+                        deployment = reconcilers[position].trigger_deployment()
+                    except Exception as e:
+                        errors[position] = fail_site(position, e)
+                        metrics.add_phase("deploy", start, metrics.now() - start, True)
+                        deployment = None
+                if deployment is None:
+                    site_logs[position].flush()
+                else:
+                    deployments[deployment.status] = (position, deployment, start)
+
+            for status in as_completed(deployments):
+                position, deployment, start = deployments[status]
+                run, site_conf = site_jobs[position]
+                with metrics.site(site_label(run, site_conf)):
+                    try:
+                        reconcilers[position].finish_deployment(deployment)
+                    except Exception as e:
+                        errors[position] = fail_site(position, e)
+                    finally:
+                        metrics.add_phase(
+                            "deploy",
+                            start,
+                            metrics.now() - start,
+                            failed=errors[position] is not None,
+                        )
+                        site_logs[position].flush()
+    finally:
+        poller.close()
+
+    if fingerprint_store:
+        for (run, site_conf), error in zip(site_jobs, errors):
+            key = (run.name, site_conf["domain_name"])
+            if error is not None:
+                fingerprint_store.forget(*key)
+            elif key not in deploy_only and fingerprints.get(key):
+                fingerprint_store.record(*key, fingerprints[key])
+        fingerprint_store.save()
+
+    stats = forge_api.session.stats
+    if read_stats is not None:
+        stats = stats + read_stats
+    logger.info(
+        f"Forge API: {stats.requests} requests, {stats.throttled} throttled, "
+        f"{stats.retried} retried, {stats.budget_wait:.1f}s waiting for the rate limit"
+    )
+    metrics.write_report(metrics_file, GITHUB_STEP_SUMMARY)
+
+    failed_sites = [
+        site_label(run, site_conf)
+        for (run, site_conf), error in zip(site_jobs, errors)
+        if error is not None
+    ]
+    if failed_sites:
+        for (run, site_conf), error in zip(site_jobs, errors):
+            if error is not None:
+                logger.error(f"Site `{site_label(run, site_conf)}` failed: {error}")
+        raise Exception(
+            f"{len(failed_sites)} of {len(site_jobs)} site(s) failed: "
+            + ", ".join(failed_sites)
+        )
 
 
 if __name__ == "__main__":
+    # timings of the API calls, of the phases of each site and of local work
+    metrics = Metrics()
+    profiling = nullcontext()
+    if PROFILE:
+        from profiling import profile_run
+
+        profiling = profile_run(metrics, PROFILE_DIR)
     try:
-        main()
-    except requests.exceptions.HTTPError as http_err:
-        logger.error("HTTP error occurred: %s", http_err, exc_info=True)
-        sys.exit(1)
+        with profiling:
+            main(metrics)
     except Exception as err:
         logger.error("An error occurred:\n %s", err, exc_info=True)
         sys.exit(1)
@@ -0,0 +1,261 @@
+import contextvars
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# site being reconciled by the current thread (or poller check), None for server-wide work
+current_site: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    "current_site", default=None
+)
+
+
+@dataclass
+class ApiCall:
+    endpoint: str  # URL template, e.g. `/servers/{id}/sites`
+    method: str
+    status: int | None  # None when no response was received
+    start: float  # seconds since the start of the run
+    latency: float  # seconds, retries and rate limit waits included
+    bytes_sent: int
+    bytes_received: int
+    retries: int
+    site: str | None
+
+
+@dataclass
+class Span:
+    """Any other timed work of the run, e.g. a sleep or template rendering."""
+
+    name: str
+    category: str  # sleep | wait | render | validate | plan
+    start: float  # seconds since the start of the run
+    duration: float
+    site: str | None
+
+
+@dataclass
+class PhaseTiming:
+    site: str
+    phase: str
+    start: float  # seconds since the start of the run
+    duration: float
+    failed: bool
+
+
+def endpoint_template(url: str) -> str:
+    """Path of `url` relative to the organization, with the IDs replaced by `{id}`."""
+    segments = urlsplit(url).path.strip("/").split("/")
+    if "orgs" in segments:
+        segments = segments[segments.index("orgs") + 2 :]
+    return "/" + "/".join(
+        "{id}" if re.fullmatch(r"\d+", segment) else segment for segment in segments
+    )
+
+
+class Metrics:
+    """
+    Timings of a run: every Forge API call and every reconcile phase of each site.
+    Shared by the API clients and the reconcilers, safe to use from any thread.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.calls: list[ApiCall] = []
+        self.phases: list[PhaseTiming] = []
+        self.spans: list[Span] = []
+        self.thread_sites: dict[int, str] = {}  # thread ID -> site it reconciles
+        self._lock = threading.Lock()
+
+    def now(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def record_call(
+        self,
+        method: str,
+        url: str,
+        status: int | None,
+        start: float,
+        bytes_sent: int = 0,
+        bytes_received: int = 0,
+        retries: int = 0,
+    ):
+        """Record a call started at `start` (from `now()`) that just completed."""
+        call = ApiCall(
+            endpoint=endpoint_template(url),
+            method=method.upper(),
+            status=status,
+            start=start,
+            latency=self.now() - start,
+            bytes_sent=bytes_sent,
+            bytes_received=bytes_received,
+            retries=retries,
+            site=current_site.get(),
+        )
+        with self._lock:
+            self.calls.append(call)
+
+    @contextmanager
+    def site(self, name: str):
+        """Attribute the calls and phases of the enclosed block to site `name`."""
+        token = current_site.set(name)
+        thread_id = threading.get_ident()
+        self.thread_sites[thread_id] = name
+        try:
+            yield
+        finally:
+            current_site.reset(token)
+            self.thread_sites.pop(thread_id, None)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = self.now()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.add_phase(name, start, self.now() - start, failed)
+
+    def add_phase(self, name: str, start: float, duration: float, failed=False):
+        """Record a phase of `duration` seconds started at `start` (from `now()`)."""
+        timing = PhaseTiming(
+            site=current_site.get() or "",
+            phase=name,
+            start=start,
+            duration=duration,
+            failed=failed,
+        )
+        with self._lock:
+            self.phases.append(timing)
+
+    def add_span(self, name: str, category: str, start: float, duration: float):
+        """Record work of `duration` seconds started at `start` (from `now()`)."""
+        span = Span(name, category, start, duration, current_site.get())
+        with self._lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name: str, category: str):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add_span(name, category, start, self.now() - start)
+
+    def records(self) -> tuple[list[ApiCall], list[PhaseTiming], list[Span]]:
+        with self._lock:
+            return list(self.calls), list(self.phases), list(self.spans)
+
+    def endpoint_stats(self) -> list[dict]:
+        """Calls aggregated per method and endpoint, slowest in total first."""
+        with self._lock:
+            calls = list(self.calls)
+
+        stats = {}
+        for call in calls:
+            entry = stats.setdefault(
+                (call.method, call.endpoint),
+                {
+                    "method": call.method,
+                    "endpoint": call.endpoint,
+                    "calls": 0,
+                    "errors": 0,
+                    "retries": 0,
+                    "total_latency": 0.0,
+                    "max_latency": 0.0,
+                    "bytes_sent": 0,
+                    "bytes_received": 0,
+                },
+            )
+            entry["calls"] += 1
+            entry["errors"] += call.status is None or call.status >= 400
+            entry["retries"] += call.retries
+            entry["total_latency"] += call.latency
+            entry["max_latency"] = max(entry["max_latency"], call.latency)
+            entry["bytes_sent"] += call.bytes_sent
+            entry["bytes_received"] += call.bytes_received
+        return sorted(stats.values(), key=lambda e: e["total_latency"], reverse=True)
+
+    def site_phases(self) -> dict[str, dict[str, float]]:
+        """Seconds spent in each phase, per site."""
+        with self._lock:
+            phases = list(self.phases)
+
+        sites = {}
+        for timing in phases:
+            site = sites.setdefault(timing.site, {})
+            site[timing.phase] = site.get(timing.phase, 0.0) + timing.duration
+        return sites
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            calls = [asdict(call) for call in self.calls]
+            phases = [asdict(timing) for timing in self.phases]
+        return {
+            "duration": self.now(),
+            "endpoints": self.endpoint_stats(),
+            "sites": self.site_phases(),
+            "calls": calls,
+            "phases": phases,
+        }
+
+    def format_markdown(self) -> str:
+        lines = [f"### Forge deployment timings ({self.now():.1f}s)", ""]
+
+        site_phases = self.site_phases()
+        # phases of the whole run, e.g. reading the servers
+        for phase, duration in site_phases.pop("", {}).items():
+            lines += [f"{phase}: {duration:.1f}s", ""]
+        if site_phases:
+            phase_names = []
+            for phases in site_phases.values():
+                phase_names += [p for p in phases if p not in phase_names]
+            lines.append("| Site | " + " | ".join(phase_names) + " | Total |")
+            lines.append("| --- |" + " ---: |" * (len(phase_names) + 1))
+            for site, phases in site_phases.items():
+                cells = [
+                    f"{phases[p]:.1f}s" if p in phases else "-" for p in phase_names
+                ]
+                total = sum(phases.values())
+                lines.append(
+                    f"| `{site}` | " + " | ".join(cells) + f" | {total:.1f}s |"
+                )
+            lines.append("")
+
+        endpoints = self.endpoint_stats()
+        lines.append(
+            "| Method | Endpoint | Calls | Errors | Retries | Total | Mean | Max | Received |"
+        )
+        lines.append("| --- | --- | ---: | ---: | ---: | ---: | ---: | ---: | ---: |")
+        for e in endpoints:
+            lines.append(
+                f"| {e['method']} | `{e['endpoint']}` | {e['calls']} | {e['errors']} "
+                f"| {e['retries']} | {e['total_latency']:.1f}s "
+                f"| {e['total_latency'] / e['calls'] * 1000:.0f}ms "
+                f"| {e['max_latency'] * 1000:.0f}ms "
+                f"| {e['bytes_received'] / 1024:.1f} KiB |"
+            )
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, json_path: str, summary_path: str | None = None):
+        """Write the JSON report, and the markdown tables to the step summary if given."""
+        try:
+            os.makedirs(os.path.dirname(json_path) or ".", exist_ok=True)
+            with open(json_path, "w") as file:
+                json.dump(self.to_dict(), file, indent=2)
+            if summary_path:
+                with open(summary_path, "a") as file:
+                    file.write(self.format_markdown())
+        except OSError as e:
+            # timings are informative, never fail the run because of them
+            logger.warning(f"Failed to write timing report: {e}")
+            return
+        logger.info(f"Timing report saved to {json_path}")
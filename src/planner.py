@@ -0,0 +1,365 @@
+import asyncio
+import os
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+from reconciler import (
+    build_deployment_script,
+    build_environment,
+    deployment_script_hash,
+    diff_environment,
+    environment_hashes,
+    format_environment,
+    get_scheduler_command,
+    get_site_dir,
+)
+from process_index import DaemonDiff, DaemonIndex, JobIndex
+from utils import cat_paths, format_php_version
+
+if TYPE_CHECKING:
+    from async_forge_api import AsyncForgeApi
+
+# phases that always run when applying, they are cheap when nothing changed
+ALWAYS_APPLIED_PHASES = {"site", "deploy"}
+
+
+@dataclass
+class Operation:
+    phase: str  # reconciler phase applying the change (see SiteReconciler.PHASES)
+    action: str  # create | update | delete
+    description: str
+
+
+@dataclass
+class SiteState:
+    """Current state of an existing site, as read from Forge."""
+
+    domains: list = field(default_factory=list)
+    nginx_config: str | None = None
+    environment: str | None = None
+    deployment_script: str | None = None
+    certificates: dict = field(default_factory=dict)  # domain id -> certificate
+
+
+@dataclass
+class ServerState:
+    """Current state of a server and of the configured sites, as read from Forge."""
+
+    sites: list
+    php_versions: list
+    daemons: list
+    jobs: list
+    nginx_templates: dict  # template name -> template (None if missing)
+    site_states: dict = field(default_factory=dict)  # domain name -> SiteState
+    daemon_index: DaemonIndex = field(init=False)
+    job_index: JobIndex = field(init=False)
+
+    def __post_init__(self):
+        self.daemon_index = DaemonIndex(self.daemons)
+        self.job_index = JobIndex(self.jobs)
+
+
+@dataclass
+class SitePlan:
+    domain_name: str
+    site: dict | None  # None when the site has to be created
+    operations: list[Operation] = field(default_factory=list)
+    daemon_ids: list = field(default_factory=list)  # site daemons that are kept
+    deployment_script_hash: str | None = None  # hash of the current script
+    environment_hashes: dict | None = None  # variable -> value hash, if the site exists
+
+    def add(self, phase, action, description):
+        self.operations.append(Operation(phase, action, description))
+
+    def has_changes(self, phase=None):
+        return any(
+            op.phase == phase if phase else op.action != "deploy"
+            for op in self.operations
+        )
+
+    def should_apply(self, phase):
+        if self.site is None or phase in ALWAYS_APPLIED_PHASES:
+            return True
+        return self.has_changes(phase)
+
+
+async def read_server_state(
+    async_api: "AsyncForgeApi", server_id, site_confs: list
+) -> ServerState:
+    """Read everything needed to plan the sites, with all requests in flight together."""
+    template_names = sorted(
+        {s["nginx_template"] for s in site_confs if s.get("nginx_template")}
+    )
+
+    sites, php_versions, daemons, jobs, *templates = await asyncio.gather(
+        async_api.get_all_sites(server_id),
+        async_api.get_server_installed_php_versions(server_id),
+        async_api.get_server_daemons(server_id),
+        async_api.get_server_jobs(server_id),
+        *[
+            async_api.get_nginx_templates_by_name(server_id, name)
+            for name in template_names
+        ],
+    )
+    state = ServerState(
+        sites=sites,
+        php_versions=php_versions,
+        daemons=daemons,
+        jobs=jobs,
+        nginx_templates=dict(zip(template_names, templates)),
+    )
+
+    sites_by_name = {site["attributes"]["name"]: site for site in sites}
+    existing = [
+        (site_conf, sites_by_name[site_conf["domain_name"]])
+        for site_conf in site_confs
+        if site_conf["domain_name"] in sites_by_name
+    ]
+    site_states = await asyncio.gather(
+        *[
+            _read_site_state(async_api, server_id, site, site_conf)
+            for site_conf, site in existing
+        ]
+    )
+    state.site_states = {
+        site_conf["domain_name"]: site_state
+        for (site_conf, _), site_state in zip(existing, site_states)
+    }
+    return state
+
+
+async def _read_site_state(async_api: "AsyncForgeApi", server_id, site, site_conf):
+    site_id = site["id"]
+
+    async def nothing():
+        return None
+
+    domains, nginx, environment, script = await asyncio.gather(
+        async_api.get_site_domains(server_id, site_id),
+        (
+            async_api.get_nginx_config(server_id, site_id)
+            if site_conf.get("nginx_custom_config")
+            else nothing()
+        ),
+        async_api.get_site_environment(server_id, site_id),
+        (
+            async_api.get_deployment_script(server_id, site_id)
+            if site_conf.get("deployment_script")
+            else nothing()
+        ),
+    )
+
+    certificates = {}
+    if site_conf["certificate"]:
+        domain_ids = [
+            d["id"]
+            for d in domains
+            if not d["attributes"]["name"].endswith(".on-forge.com")
+        ]
+        certs = await asyncio.gather(
+            *[
+                async_api.get_domain_certificate(server_id, site_id, domain_id)
+                for domain_id in domain_ids
+            ]
+        )
+        certificates = dict(zip(domain_ids, certs))
+
+    return SiteState(
+        domains=domains,
+        nginx_config=nginx["attributes"]["content"] if nginx else None,
+        environment=environment["attributes"]["content"] if environment else None,
+        deployment_script=script["attributes"]["content"] if script else None,
+        certificates=certificates,
+    )
+
+
+def plan_site(
+    site_conf: dict,
+    state: ServerState,
+    source_repo_path: str,
+    secrets: dict | None,
+) -> SitePlan:
+    """Compute the operations needed to bring the site in line with its configuration."""
+    domain_name = site_conf["domain_name"]
+    site = next(
+        (s for s in state.sites if s["attributes"]["name"] == domain_name), None
+    )
+    site_state = state.site_states.get(domain_name, SiteState())
+    plan = SitePlan(domain_name, site)
+    site_dir = get_site_dir(site_conf)
+
+    # php
+    php_version = site_conf.get("php_version")
+    if php_version and format_php_version(php_version) not in [
+        php["attributes"]["binary_name"] for php in state.php_versions
+    ]:
+        plan.add("php", "create", f"install php version `{php_version}` on server")
+
+    # site
+    if site is None:
+        template_name = site_conf.get("nginx_template")
+        if template_name and not state.nginx_templates.get(template_name):
+            plan.add("site", "create", f"create nginx template `{template_name}`")
+        plan.add("site", "create", "create site")
+    else:
+        if site["attributes"]["repository"]["branch"] != site_conf["github_branch"]:
+            plan.add(
+                "site",
+                "update",
+                f"set branch `{site['attributes']['repository']['branch']}` -> `{site_conf['github_branch']}`",
+            )
+        if site["attributes"]["quick_deploy"] == True:
+            plan.add("site", "update", "disable quick deploy")
+
+    # aliases
+    existing_aliases = [
+        d["attributes"]["name"]
+        for d in site_state.domains
+        if d["attributes"]["type"] != "primary"
+    ]
+    for alias in existing_aliases:
+        if alias not in site_conf["aliases"]:
+            plan.add("aliases", "delete", f"delete domain `{alias}`")
+    for alias in site_conf["aliases"]:
+        if alias not in existing_aliases:
+            plan.add("aliases", "create", f"add domain `{alias}`")
+
+    # nginx custom config
+    if site_conf.get("nginx_custom_config"):
+        nginx_custom_file_path = cat_paths(
+            source_repo_path, site_conf.get("nginx_custom_config")
+        )
+        if not os.path.exists(nginx_custom_file_path):
+            raise Exception(
+                f"Nginx config file `{site_conf.get('nginx_custom_config')} doesn't exist."
+            )
+        with open(nginx_custom_file_path, "r") as file:
+            if file.read() != site_state.nginx_config:
+                plan.add("nginx", "update", "update nginx config")
+
+    # php version
+    site_php_label = site["attributes"]["php_version"] if site else None
+    if site and php_version:
+        site_php_version = site_php_label.replace("PHP ", "php").replace(".", "")
+        if php_version != site_php_version:
+            plan.add(
+                "php_version",
+                "update",
+                f"set php version `{site_php_version}` -> `{php_version}`",
+            )
+            site_php_label = format_php_version(php_version)
+
+    # daemons
+    daemon_diff = (
+        state.daemon_index.diff(site_dir, site_conf["processes"])
+        if site
+        else DaemonDiff(create=list(site_conf["processes"]))
+    )
+    for daemon in daemon_diff.delete:
+        plan.add(
+            "daemons",
+            "delete",
+            f"delete daemon-{daemon['id']} `{daemon['attributes']['command']}`",
+        )
+    plan.daemon_ids = [daemon["id"] for daemon in daemon_diff.keep]
+    for process in daemon_diff.create:
+        plan.add("daemons", "create", f"create daemon `{process['command']}`")
+
+    # scheduler
+    if site_conf["project_type"] == "laravel":
+        scheduler_php_label = site_php_label or format_php_version(php_version or "")
+        scheduler_cmd = get_scheduler_command(scheduler_php_label, site_dir)
+        job_exists = (
+            site is not None and state.job_index.find(scheduler_cmd) is not None
+        )
+        if site_conf["laravel_scheduler"] and not job_exists:
+            plan.add("scheduler", "create", f"create scheduler job `{scheduler_cmd}`")
+        elif not site_conf["laravel_scheduler"] and job_exists:
+            plan.add("scheduler", "delete", f"delete scheduler job `{scheduler_cmd}`")
+
+    # deployment script
+    if site_conf.get("deployment_script"):
+        daemons_created = any(
+            op.phase == "daemons" and op.action == "create" for op in plan.operations
+        )
+        script = build_deployment_script(site_conf, site_dir, plan.daemon_ids)
+        current_hash = deployment_script_hash(site_state.deployment_script)
+        plan.deployment_script_hash = current_hash
+        if daemons_created or current_hash != deployment_script_hash(script):
+            plan.add("script", "update", "update deployment script")
+
+    # environment
+    if site is not None:
+        plan.environment_hashes = environment_hashes(site_state.environment)
+    env_diff = diff_environment(
+        plan.environment_hashes or {},
+        environment_hashes(
+            format_environment(build_environment(site_conf, source_repo_path, secrets))
+        ),
+    )
+    if env_diff:
+        plan.add(
+            "env", "update", f"update environment variables: {env_diff.describe()}"
+        )
+
+    # certificates
+    if site_conf["certificate"]:
+        domains = {
+            d["id"]: d["attributes"]["name"]
+            for d in site_state.domains
+            if d["attributes"]["name"] not in existing_aliases
+            or d["attributes"]["name"] in site_conf["aliases"]
+        }
+        for domain_id, name in domains.items():
+            if name.endswith(".on-forge.com"):
+                continue
+            if not site_state.certificates.get(domain_id):
+                plan.add("certificate", "create", f"install certificate for `{name}`")
+        new_domains = [a for a in site_conf["aliases"] if a not in existing_aliases]
+        if site is None and not domain_name.endswith(".on-forge.com"):
+            new_domains.insert(0, domain_name)
+        for name in new_domains:
+            if not name.endswith(".on-forge.com"):
+                plan.add("certificate", "create", f"install certificate for `{name}`")
+
+    if site_conf["clone_repository"]:
+        plan.add("deploy", "deploy", "deploy site")
+
+    return plan
+
+
+def deploy_only_plan(site_conf: dict, site: dict | None) -> SitePlan | None:
+    """
+    Plan of a site whose configuration didn't change since it was last reconciled:
+    it is only deployed. None when the site doesn't exist anymore.
+    """
+    if site is None:
+        return None
+    plan = SitePlan(site_conf["domain_name"], site)
+    if site_conf["clone_repository"]:
+        plan.add("deploy", "deploy", "deploy site (configuration unchanged)")
+    return plan
+
+
+_SYMBOLS = {"create": "+", "update": "~", "delete": "-", "deploy": ">"}
+
+
+def format_plan(plans: list[SitePlan]) -> str:
+    lines = []
+    counts = {"create": 0, "update": 0, "delete": 0}
+    unchanged = 0
+    for plan in plans:
+        lines.append(f"Site `{plan.domain_name}`:")
+        for op in plan.operations:
+            lines.append(f"  {_SYMBOLS[op.action]} {op.description}")
+            if op.action in counts:
+                counts[op.action] += 1
+        if not plan.has_changes():
+            unchanged += 1
+            lines.append("  (no changes)")
+
+    lines.append(
+        f"Plan: {counts['create']} to create, {counts['update']} to update, "
+        f"{counts['delete']} to delete; {unchanged} of {len(plans)} site(s) unchanged."
+    )
+    return "\n".join(lines)
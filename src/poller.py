@@ -0,0 +1,182 @@
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
+
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class PollProfile:
+    """How often a kind of resource is polled while it is pending."""
+
+    typical: float  # usual duration of the operation, in seconds
+    min_interval: float
+    max_interval: float
+    timeout: float | None  # None waits forever
+
+    def interval(self, elapsed: float, typical: float) -> float:
+        """Delay before the next check of a resource pending for `elapsed` seconds."""
+        step = typical / 10
+        if elapsed < typical:
+            # doubling at first (quick operations), then closing half of the gap to
+            # the typical duration, so the checks are densest when it's likely done
+            interval = max(min(elapsed, (typical - elapsed) / 2), min(step, elapsed))
+        else:
+            # overdue, back off as it becomes less predictable
+            interval = max((elapsed - typical) / 2, step)
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        # spread the checks of resources started together
+        return interval * random.uniform(0.8, 1.2)
+
+
+# starting points, the typical durations are then learned from the run
+PROFILES = {
+    "php": PollProfile(typical=120, min_interval=1, max_interval=30, timeout=15 * 60),
+    "site": PollProfile(typical=15, min_interval=0.5, max_interval=10, timeout=5 * 60),
+    "certificate": PollProfile(
+        typical=20, min_interval=0.5, max_interval=10, timeout=5 * 60
+    ),
+    "deployment": PollProfile(
+        typical=45, min_interval=1, max_interval=15, timeout=None
+    ),
+}
+
+
+@dataclass
+class _Watch:
+    check: Callable
+    kind: str
+    profile: PollProfile
+    future: Future
+    started_at: float
+    deadline: float | None
+    context: contextvars.Context  # of the caller, checks run in it
+
+
+class Poller:
+    """
+    Polls many pending Forge resources from one scheduler thread.
+
+    `watch(check, kind)` returns a future resolved with the first truthy value
+    returned by `check`, with False when the deadline of the resource passes, or
+    with the exception raised by `check`. Checks run on a small thread pool, so a
+    slow request doesn't delay the other resources.
+
+    Checks are scheduled around the typical duration of each kind of resource,
+    which is updated as resources of that kind complete.
+
+        poller = Poller()
+        future = poller.watch(lambda: is_deployed(site_id), "deployment")
+        future.add_done_callback(...)  # or future.result()
+    """
+
+    def __init__(self, max_workers=8, metrics: Metrics | None = None):
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="poller")
+        self._queue = []  # heap of (due time, sequence, watch)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self._typical = {kind: profile.typical for kind, profile in PROFILES.items()}
+        self.metrics = metrics
+
+    def watch(self, check: Callable, kind: str) -> Future:
+        """Poll `check` until it returns a truthy value, `kind` selects the profile."""
+        profile = PROFILES[kind]
+        future = Future()
+        future.set_running_or_notify_cancel()
+        now = time.monotonic()
+        watch = _Watch(
+            check=check,
+            kind=kind,
+            profile=profile,
+            future=future,
+            started_at=now,
+            deadline=now + profile.timeout if profile.timeout is not None else None,
+            context=contextvars.copy_context(),
+        )
+        # the first check is immediate, the resource may already be ready
+        self._schedule(watch, now)
+        return future
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _schedule(self, watch: _Watch, due: float):
+        with self._condition:
+            if self._closed:
+                watch.future.set_exception(RuntimeError("Poller is closed"))
+                return
+            heapq.heappush(self._queue, (due, next(self._sequence), watch))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="poller", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        return
+                    if not self._queue:
+                        self._condition.wait()
+                        continue
+                    delay = self._queue[0][0] - time.monotonic()
+                    if delay <= 0:
+                        _, _, watch = heapq.heappop(self._queue)
+                        break
+                    self._condition.wait(delay)
+
+            self._executor.submit(self._check, watch)
+
+    def _check(self, watch: _Watch):
+        try:
+            result = watch.context.run(watch.check)
+        except Exception as e:
+            watch.future.set_exception(e)
+            return
+
+        now = time.monotonic()
+        elapsed = now - watch.started_at
+        if result:
+            logger.debug(f"{watch.kind} ready after {elapsed:.1f}s")
+            with self._condition:
+                typical = self._typical[watch.kind]
+                self._typical[watch.kind] = 0.7 * typical + 0.3 * elapsed
+            self._record(watch, elapsed)
+            watch.future.set_result(result)
+            return
+        if watch.deadline is not None and now >= watch.deadline:
+            self._record(watch, elapsed)
+            watch.future.set_result(False)
+            return
+
+        due = now + watch.profile.interval(elapsed, self._typical[watch.kind])
+        if watch.deadline is not None:
+            due = min(due, watch.deadline)
+        self._schedule(watch, due)
+
+    def _record(self, watch: _Watch, elapsed: float):
+        if self.metrics:
+            watch.context.run(
+                self.metrics.add_span,
+                watch.kind,
+                "wait",
+                self.metrics.now() - elapsed,
+                elapsed,
+            )
@@ -0,0 +1,73 @@
+import posixpath
+from dataclasses import dataclass, field
+
+
+def normalize_remote_dir(path: str) -> str:
+    """Normalize a directory of the server. Lexical only, it doesn't exist locally."""
+    return posixpath.normpath(path)
+
+
+@dataclass
+class DaemonDiff:
+    delete: list[dict] = field(default_factory=list)  # daemons not configured anymore
+    keep: list[dict] = field(default_factory=list)  # daemons still configured
+    create: list[dict] = field(default_factory=list)  # processes without a daemon
+
+
+class DaemonIndex:
+    """Daemons of a server indexed by (normalized directory, command)."""
+
+    def __init__(self, daemons=()):
+        # directory -> daemon id -> daemon, in server order
+        self._by_dir: dict[str, dict[int, dict]] = {}
+        self._dirs: dict[int, str] = {}  # daemon id -> directory
+        for daemon in daemons:
+            self.add(daemon)
+
+    def add(self, daemon: dict):
+        directory = normalize_remote_dir(daemon["attributes"]["directory"])
+        self._by_dir.setdefault(directory, {})[daemon["id"]] = daemon
+        self._dirs[daemon["id"]] = directory
+
+    def remove(self, daemon_id):
+        directory = self._dirs.pop(daemon_id, None)
+        if directory is not None:
+            self._by_dir[directory].pop(daemon_id, None)
+
+    def in_directory(self, directory: str) -> list[dict]:
+        return list(self._by_dir.get(normalize_remote_dir(directory), {}).values())
+
+    def diff(self, directory: str, processes: list[dict]) -> DaemonDiff:
+        """Compare the daemons running in `directory` with the configured processes."""
+        commands = {process["command"] for process in processes}
+        diff = DaemonDiff()
+        running = set()
+        for daemon in self.in_directory(directory):
+            command = daemon["attributes"]["command"]
+            running.add(command)
+            (diff.keep if command in commands else diff.delete).append(daemon)
+        diff.create = [p for p in processes if p["command"] not in running]
+        return diff
+
+
+class JobIndex:
+    """Scheduled jobs of a server indexed by command."""
+
+    def __init__(self, jobs=()):
+        self._by_command: dict[str, dict[int, dict]] = {}
+        self._commands: dict[int, str] = {}  # job id -> command
+        for job in jobs:
+            self.add(job)
+
+    def add(self, job: dict):
+        command = job["attributes"]["command"]
+        self._by_command.setdefault(command, {})[job["id"]] = job
+        self._commands[job["id"]] = command
+
+    def remove(self, job_id):
+        command = self._commands.pop(job_id, None)
+        if command is not None:
+            self._by_command[command].pop(job_id, None)
+
+    def find(self, command: str) -> dict | None:
+        return next(iter(self._by_command.get(command, {}).values()), None)
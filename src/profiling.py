@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stack of every thread at a fixed interval. Samples of a
+    thread reconciling a site are filed under that site, the others under the
+    thread name. Blocked threads are sampled too, so the samples show where the
+    wall time goes (network, sleeps) as well as CPU work.
+    """
+
+    def __init__(self, metrics: Metrics, interval: float = 0.005):
+        self.metrics = metrics
+        self.interval = interval
+        self.samples: Counter[tuple[str, ...]] = Counter()  # (lane, *frames) -> count
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                lane = self.metrics.thread_sites.get(thread_id) or names.get(
+                    thread_id, str(thread_id)
+                )
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                self.samples[(lane, *reversed(stack))] += 1
+
+    def write_folded(self, path: str):
+        """Write the samples as folded stacks (`lane;frame;...;frame count`)."""
+        with open(path, "w") as file:
+            for stack, count in self.samples.most_common():
+                file.write(";".join(stack) + f" {count}\n")
+
+
+def chrome_trace(metrics: Metrics) -> dict:
+    """
+    Timeline of the run in the Chrome trace event format (chrome://tracing,
+    Perfetto, speedscope), with one lane per site and one for server-wide work.
+    """
+    lanes = {}
+
+    def lane(site):
+        return lanes.setdefault(site or "run", len(lanes) + 1)
+
+    def event(name, category, start, duration, site, args=None):
+        return {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round(start * 1e6),
+            "dur": round(duration * 1e6),
+            "pid": 1,
+            "tid": lane(site),
+            "args": args or {},
+        }
+
+    lane(None)
+    calls, phases, spans = metrics.records()
+
+    events = [
+        event(p.phase, "phase", p.start, p.duration, p.site, {"failed": p.failed})
+        for p in phases
+    ]
+    events += [
+        event(
+            f"{c.method} {c.endpoint}",
+            "api",
+            c.start,
+            c.latency,
+            c.site,
+            {
+                "status": c.status,
+                "retries": c.retries,
+                "bytes_sent": c.bytes_sent,
+                "bytes_received": c.bytes_received,
+            },
+        )
+        for c in calls
+    ]
+    events += [event(s.name, s.category, s.start, s.duration, s.site) for s in spans]
+    # enclosing events first, so the viewers nest them
+    events.sort(key=lambda e: (e["tid"], e["ts"], -e["dur"]))
+
+    metadata = [
+        {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "forge deploy"}}
+    ]
+    for name, tid in lanes.items():
+        metadata += [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": 1,
+                "tid": tid,
+                "args": {"name": name},
+            },
+            {
+                "name": "thread_sort_index",
+                "ph": "M",
+                "pid": 1,
+                "tid": tid,
+                "args": {"sort_index": tid},
+            },
+        ]
+    return {"traceEvents": metadata + events, "displayTimeUnit": "ms"}
+
+
+@contextmanager
+def profile_run(metrics: Metrics, directory: str):
+    """
+    Sample the enclosed block and write `timeline.json` (Chrome trace) and
+    `samples.folded` (folded stacks) to `directory` when it ends.
+    """
+    profiler = SamplingProfiler(metrics)
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, "timeline.json"), "w") as file:
+                json.dump(chrome_trace(metrics), file)
+            profiler.write_folded(os.path.join(directory, "samples.folded"))
+        except OSError as e:
+            logger.warning(f"Failed to write profile: {e}")
+        else:
+            logger.info(f"Profile saved to {directory}")
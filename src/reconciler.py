@@ -0,0 +1,860 @@
+import hashlib
+import logging
+import os
+import re
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable
+
+from forge_api import ForgeApi
+from metrics import Metrics, current_site
+from poller import Poller
+from server_snapshot import ServerSnapshot
+from site_logging import DeploymentLogStream
+from task_graph import Task, TaskFailed, run_tasks
+from utils import (
+    cat_paths,
+    parse_env,
+    replace_nginx_variables,
+    replace_secrets_and_envs_yaml,
+)
+
+_UNKNOWN = object()
+
+
+def get_site_user(site_conf):
+    return site_conf.get("isolated_user") if site_conf["isolated"] else "forge"
+
+
+def get_site_dir(site_conf):
+    return cat_paths(
+        f"/home/{get_site_user(site_conf)}/",
+        site_conf["domain_name"],
+        "current/" if site_conf["zero_downtime_deployments"] else ".",
+        site_conf["root_dir"],
+    )
+
+
+def get_scheduler_command(site_php_version, site_dir):
+    """Scheduler cron command, `site_php_version` being Forge's label (ex: PHP 8.4)."""
+    scheduler_php_version = site_php_version.replace("PHP", "php").replace(" ", "")
+    return f"{scheduler_php_version} {site_dir}/artisan schedule:run"
+
+
+DEPLOYMENT_SCRIPT_HEADER = "# Generated by deployment action, do not modify"
+_SCRIPT_HASH_RE = re.compile(
+    rf"^{re.escape(DEPLOYMENT_SCRIPT_HEADER)} \(sha256: ([0-9a-f]+)\)$", re.MULTILINE
+)
+
+
+def deployment_script_hash(script):
+    """
+    Content hash embedded in the header of a generated script. None if there is
+    none, or if the content after the header doesn't match it anymore (e.g. the
+    script was edited in the Forge dashboard).
+    """
+    script = (script or "").replace("\r\n", "\n")
+    match = _SCRIPT_HASH_RE.match(script)
+    if not match:
+        return None
+    body = script[match.end() + 1 :]
+    if hashlib.sha256(body.encode()).hexdigest()[:16] != match.group(1):
+        return None
+    return match.group(1)
+
+
+def build_deployment_script(site_conf, site_dir, daemon_ids):
+    """
+    Deployment script of the site. Its header holds a hash of the content, so an
+    unchanged script can be recognized without comparing the text Forge sends back.
+    """
+    deployment_script = ""
+
+    if not site_conf["zero_downtime_deployments"]:
+        deployment_script += (
+            f"cd {site_dir}\n"
+            + "git fetch --prune --tags origin\n"
+            + 'git reset --hard "origin/$FORGE_SITE_BRANCH"\n'
+        )
+    else:
+        deployment_script += (
+            "$CREATE_RELEASE()\n"
+            + "cd $FORGE_RELEASE_DIRECTORY\n"
+            + (f"cd {site_conf['root_dir']}\n" if site_conf["root_dir"] != "." else "")
+        )
+
+    deployment_script += site_conf.get("deployment_script") + "\n"
+
+    if site_conf["zero_downtime_deployments"]:
+        deployment_script += "$ACTIVATE_RELEASE()\n"
+        if site_conf["project_type"] == "laravel":
+            deployment_script += f"$RESTART_QUEUES()\n"
+
+    for d_id in daemon_ids:
+        deployment_script += f"sudo supervisorctl restart daemon-{d_id}:*\n"
+
+    content_hash = hashlib.sha256(deployment_script.encode()).hexdigest()[:16]
+    return f"{DEPLOYMENT_SCRIPT_HEADER} (sha256: {content_hash})\n" + deployment_script
+
+
+def build_environment(site_conf, source_repo_path, secrets, logger=None):
+    """Environment variables of the site, merged from `env_file` and `environment`."""
+    site_env = {}
+    # read env file
+    if site_conf.get("env_file"):
+        env_file_path = cat_paths(source_repo_path, site_conf.get("env_file"))
+        try:
+            with open(env_file_path, "r") as file:
+                if logger:
+                    logger.info(
+                        "Loading environment variables from file `%s`",
+                        site_conf.get("env_file"),
+                    )
+                env_file_content = file.read()
+                if logger:
+                    logger.debug("Env file content:\n%s", env_file_content)
+                # replace screts
+                env_file_content = str(
+                    replace_secrets_and_envs_yaml(env_file_content, secrets)
+                )
+                # parse env
+                file_env = parse_env(env_file_content)
+                site_env.update(file_env)
+        except FileNotFoundError as e:
+            raise Exception(
+                f"Environment file `{site_conf.get('env_file')}` not found"
+            ) from e
+
+    if site_conf.get("environment"):
+        config_env = parse_env(site_conf.get("environment"))
+        site_env.update(config_env)
+
+    return site_env
+
+
+def format_environment(site_env):
+    return "# Generated by deployment action, do not modify\n" + "\n".join(
+        [f"{k}={v}" for k, v in site_env.items()]
+    )
+
+
+def environment_hashes(content):
+    """Hash of each variable of an env file, to compare values without keeping them."""
+    return {
+        key: hashlib.sha256(value.encode()).hexdigest()
+        for key, value in parse_env(content).items()
+    }
+
+
+@dataclass
+class EnvironmentDiff:
+    added: list[str] = field(default_factory=list)
+    changed: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    def describe(self):
+        """Names of the changed variables, never their values."""
+        return "; ".join(
+            f"{label} {', '.join(f'`{key}`' for key in keys)}"
+            for label, keys in (
+                ("added", self.added),
+                ("changed", self.changed),
+                ("removed", self.removed),
+            )
+            if keys
+        )
+
+
+def diff_environment(current: dict, desired: dict):
+    """Key-level diff between two `environment_hashes` results."""
+    return EnvironmentDiff(
+        added=[key for key in desired if key not in current],
+        changed=[
+            key for key in desired if key in current and current[key] != desired[key]
+        ],
+        removed=[key for key in current if key not in desired],
+    )
+
+
+@dataclass
+class PendingDeployment:
+    """A deployment started by `SiteReconciler.trigger_deployment`."""
+
+    deployment_id: int
+    log_stream: DeploymentLogStream
+    status: Future  # final status, None if the status check timed out
+    read_log: Callable[[], None]
+
+
+class SiteReconciler:
+    """Brings one site of the deployment file in line with its configuration and deploys it."""
+
+    def __init__(
+        self,
+        forge_api: ForgeApi,
+        server_id,
+        snapshot: ServerSnapshot,
+        poller: Poller,
+        site_conf: dict,
+        config: dict,
+        secrets: dict | None,
+        action_dir: str,
+        source_repo_path: str,
+        logger: logging.Logger,
+        deployment_log_dir: str,
+        metrics: Metrics,
+    ):
+        self.forge_api = forge_api
+        self.server_id = server_id
+        self.snapshot = snapshot
+        self.poller = poller
+        self.site_conf = site_conf
+        self.config = config
+        self.secrets = secrets
+        self.action_dir = action_dir
+        self.source_repo_path = source_repo_path
+        self.logger = logger
+        self.deployment_log_dir = deployment_log_dir
+        self.metrics = metrics
+
+        self.site = None
+        self.site_id = None
+        self.daemon_ids = []
+        # hash of the deployment script Forge holds, read lazily when not planned
+        self.current_script_hash = _UNKNOWN
+        # hashes of the site's environment variables, read lazily when not planned
+        self.current_env_hashes = _UNKNOWN
+
+        self.site_user = get_site_user(site_conf)
+        self.site_dir = get_site_dir(site_conf)
+
+    # phase name -> (method, phases it must run after). A phase starts as soon as
+    # the phases it depends on are done, so independent phases run together. Php
+    # installs run in the background, phases needing php wait for it themselves.
+    PHASES = {
+        "php": ("install_php_version", []),
+        "site": ("create_or_update_site", []),
+        "aliases": ("sync_aliases", ["site"]),
+        "nginx": ("set_nginx_custom_config", ["site"]),
+        "env": ("set_environment", ["site"]),
+        # certificates cover the aliases, and would be dropped by a custom config
+        "certificate": ("install_certificates", ["aliases", "nginx"]),
+        "php_version": ("sync_php_version", ["site"]),
+        "daemons": ("sync_daemons", ["site"]),
+        # the scheduler command contains the php version of the site
+        "scheduler": ("sync_scheduler", ["php_version"]),
+        # the script restarts the daemons of the site
+        "script": ("update_deployment_script", ["daemons"]),
+        "deploy": (
+            "deploy",
+            [
+                "aliases",
+                "nginx",
+                "env",
+                "certificate",
+                "php_version",
+                "scheduler",
+                "script",
+            ],
+        ),
+    }
+    MAX_PARALLEL_PHASES = 4
+    # the deployment log is fetched whole, at most this often (seconds) while the
+    # status is polled
+    DEPLOYMENT_LOG_INTERVAL = 5
+
+    def run(self, plan=None, deploy=True):
+        """
+        Reconcile and deploy the site. When a `SitePlan` is given, phases without
+        planned changes are skipped. With `deploy` False the site is only
+        reconciled, see `trigger_deployment`.
+        """
+        self.site = self.snapshot.site(self.site_conf["domain_name"])
+
+        if plan is not None:
+            self.daemon_ids = list(plan.daemon_ids)
+            self.current_script_hash = plan.deployment_script_hash
+            if plan.environment_hashes is not None:
+                self.current_env_hashes = plan.environment_hashes
+
+        # phases run on their own threads, keep them attributed to the site
+        site_label = current_site.get() or self.site_conf["domain_name"]
+
+        def phase_task(phase, method, after):
+            def run_phase():
+                with self.metrics.site(site_label), self.metrics.phase(phase):
+                    getattr(self, method)()
+
+            # skipped phases still order the phases around them
+            apply = (plan is None or plan.should_apply(phase)) and (
+                deploy or phase != "deploy"
+            )
+            return Task(phase, run_phase if apply else None, after)
+
+        try:
+            run_tasks(
+                [
+                    phase_task(phase, method, after)
+                    for phase, (method, after) in self.PHASES.items()
+                ],
+                max_workers=self.MAX_PARALLEL_PHASES,
+            )
+        except TaskFailed as e:
+            if e.skipped:
+                self.logger.warning(f"Skipped after a failure: {', '.join(e.skipped)}")
+            if len(e.errors) == 1:
+                raise next(iter(e.errors.values()))
+            for phase, error in e.errors.items():
+                self.logger.error(f"Phase `{phase}` failed: {error}")
+            raise Exception(f"{len(e.errors)} phases failed: {e}") from e
+
+    # install site's php version in server, without waiting for it
+    def install_php_version(self):
+        version = self.site_conf.get("php_version")
+        if not version:
+            return
+        if not self.snapshot.php_version_ready(version, self.poller).done():
+            self.logger.info(f"Php version {version} is being installed...")
+
+    def wait_for_php_version(self):
+        """Block until the php version of the site is installed on the server."""
+        version = self.site_conf.get("php_version")
+        if not version:
+            return
+
+        future = self.snapshot.php_version_ready(version, self.poller)
+        if not future.done():
+            self.logger.info(f"Waiting for php version {version} to be installed...")
+        try:
+            installed = future.result()
+        except Exception as e:
+            raise Exception(f"Failed to install php version: {e}") from e
+        if not installed:
+            raise Exception("Failed to install php version: Php installation timed out")
+        self.logger.debug(f"Php version {version} installed")
+
+    def create_or_update_site(self):
+        forge_api, server_id, site_conf = self.forge_api, self.server_id, self.site_conf
+
+        if self.site:
+            self.logger.info("Site already exists")
+            update_payload = {}
+            if (
+                self.site["attributes"]["repository"]["branch"]
+                != site_conf["github_branch"]
+            ):
+                update_payload["repository_branch"] = site_conf["github_branch"]
+                self.logger.info("Updating site branch ...")
+
+            if self.site["attributes"]["quick_deploy"] == True:
+                update_payload["push_to_deploy"] = False
+                self.logger.info("Disabling quick deploy ...")
+
+            if update_payload:
+                forge_api.update_site(server_id, self.site["id"], **update_payload)
+                self.logger.info("Site updated successfully")
+
+            self.site_id = self.site["id"]
+            self.logger.debug(f"Site: %s", self.site)
+            return
+
+        # nginx template
+        nginx_template_id = None
+        if site_conf.get("nginx_template"):
+            nginx_template_id = self._get_or_create_nginx_template(
+                site_conf["nginx_template"]
+            )
+
+        # Normalize shared paths to have both 'from' and 'to'
+        # TODO: if forge adds a way to update shared paths after site creation implement it
+        shared_paths_normalized = []
+        for path in site_conf["shared_paths"]:
+            if isinstance(path, str):
+                # String format: use same path for both from and to
+                shared_paths_normalized.append({"from": path, "to": path})
+            elif isinstance(path, dict):
+                # Dict format: already has from and to
+                shared_paths_normalized.append({"from": path["from"], "to": path["to"]})
+
+        create_site_payload = {
+            "name": site_conf["name"],
+            "domain_mode": site_conf["domain_mode"],
+            "www_redirect_type": site_conf["www_redirect_type"],
+            "allow_wildcard_subdomains": False,
+            "type": site_conf["project_type"],
+            "root_directory": site_conf["root_dir"],
+            "web_directory": site_conf["web_dir"],
+            "is_isolated": site_conf["isolated"],
+            "isolated_user": site_conf.get("isolated_user"),
+            "nginx_template_id": nginx_template_id,
+            "push_to_deploy": False,
+            "php_version": site_conf.get("php_version"),
+            "zero_downtime_deployments": site_conf["zero_downtime_deployments"],
+            "shared_paths": (
+                shared_paths_normalized if len(shared_paths_normalized) > 0 else None
+            ),
+        }
+
+        create_site_payload = {
+            k: v for k, v in create_site_payload.items() if v is not None
+        }  # Remove None values
+
+        # add repository
+        if site_conf["clone_repository"]:
+
+            create_site_payload["source_control_provider"] = "github"
+            create_site_payload["repository"] = self.config["github_repository"]
+            create_site_payload["branch"] = site_conf["github_branch"]
+            create_site_payload["install_composer_dependencies"] = site_conf[
+                "install_composer_dependencies"
+            ]
+
+        # forge sets up the site with its php version
+        self.wait_for_php_version()
+
+        # create site
+        self.logger.info("Creating site...")
+        self.site = forge_api.create_site(server_id, create_site_payload)
+        self.site_id = self.site["id"]
+
+        def until_site_installed():
+            site = forge_api.get_site_by_id(server_id, self.site_id)
+            return site["attributes"]["status"] == "installed" and (
+                not site_conf["clone_repository"]
+                or site["attributes"]["repository"]["status"] == "installed"
+            )
+
+        if not self.poller.watch(until_site_installed, "site").result():
+            raise Exception("Adding repository timed out")
+
+        self.logger.info("Site created successfully")
+
+        # set site nginx variables
+        try:
+            nginx_config = forge_api.get_nginx_config(server_id, self.site_id)[
+                "attributes"
+            ]["content"]
+            with self.metrics.span("nginx variables", "render"):
+                nginx_config = replace_nginx_variables(
+                    nginx_config, site_conf["nginx_template_variables"]
+                )
+            forge_api.set_nginx_config(server_id, self.site_id, nginx_config)
+        except Exception as e:
+            raise Exception(f"Failed to set nginx config variables: {e}") from e
+
+        self.logger.debug(f"Site: %s", self.site)
+
+    def _get_or_create_nginx_template(self, template_name):
+        snapshot = self.snapshot
+
+        with snapshot.changes_lock:
+            nginx_templates = snapshot.nginx_template(template_name)
+            nginx_template_id = nginx_templates.get("id") if nginx_templates else None
+            if nginx_template_id:
+                return nginx_template_id
+
+            # if template isn't added in the server add it from nginx-templates folder
+            nginx_template_path = cat_paths(
+                self.action_dir,
+                "nginx_templates/",
+                f"{template_name}.conf",
+            )
+            self.logger.info("Nginx template not created in the server")
+            self.logger.info("Creating nginx template...")
+            if not os.path.exists(nginx_template_path):
+                raise Exception("Invalid nginx template name")
+
+            with open(nginx_template_path, "r") as file:
+                nginx_template_id = snapshot.create_nginx_template(
+                    template_name, file.read()
+                )
+            self.logger.info("Nginx template created successfully")
+            return nginx_template_id
+
+    # ---- update aliases ----
+    def sync_aliases(self):
+        forge_api, server_id, site_id = self.forge_api, self.server_id, self.site_id
+        try:
+            # TODO: change aliases to extra_domains (or smtng like that) and add www redirect type option
+            existing_domains = forge_api.get_site_domains(server_id, site_id)
+            existing_domains_list = [
+                domain["attributes"]["name"]
+                for domain in existing_domains
+                if domain["attributes"]["type"] != "primary"
+            ]
+            config_aliases = self.site_conf["aliases"]
+
+            # If aliases are not the same, sync them
+            if set(existing_domains_list) != set(config_aliases):
+                # Delete domains that exist in site but not in config
+                for domain in existing_domains:
+                    domain_name = domain["attributes"]["name"]
+                    if (
+                        domain["attributes"]["type"] != "primary"
+                        and domain_name not in config_aliases
+                    ):
+                        forge_api.delete_site_domain(server_id, site_id, domain["id"])
+                        self.logger.info(f"Domain '{domain_name}' deleted from site.")
+
+                # Create domains that exist in config but not in site
+                for alias in config_aliases:
+                    if alias not in existing_domains_list:
+                        forge_api.create_site_domain(server_id, site_id, alias)
+                        self.logger.info(f"Domain '{alias}' added to site.")
+
+                self.logger.info("Site aliases configured successfully.")
+
+        except Exception as e:
+            raise Exception("Error updating aliases.") from e
+
+    # ---- nginx custom config ----
+    def set_nginx_custom_config(self):
+        forge_api, server_id, site_id = self.forge_api, self.server_id, self.site_id
+        site_conf = self.site_conf
+        try:
+            if site_conf.get("nginx_custom_config"):
+                nginx_custom_file_path = cat_paths(
+                    self.source_repo_path, site_conf.get("nginx_custom_config")
+                )
+                with open(nginx_custom_file_path, "r") as file:
+                    nginx_custom_content = file.read()
+
+                self.logger.debug(
+                    f"Nginx custom config file content:\n{nginx_custom_content}"
+                )
+                # compare existing site nginx config and the one in the file if different update
+                site_existing_nginx_config = forge_api.get_nginx_config(
+                    server_id, site_id
+                )["attributes"]["content"]
+                if site_existing_nginx_config != nginx_custom_content:
+                    forge_api.set_nginx_config(server_id, site_id, nginx_custom_content)
+                    self.logger.info(f"Nginx config updated.")
+        except FileNotFoundError as e:
+            raise Exception(
+                f"Nginx config file `{site_conf.get('nginx_custom_config')} doesn't exist."
+            ) from e
+        except Exception as e:
+            raise Exception("Error when trying to set custom nginx config") from e
+
+    # ---- php version ----
+    def sync_php_version(self):
+        forge_api, server_id, site_id = self.forge_api, self.server_id, self.site_id
+        site_conf = self.site_conf
+        try:
+            site_php_version = (
+                forge_api.get_site_by_id(server_id, site_id)["attributes"][
+                    "php_version"
+                ]
+                .replace("PHP ", "php")
+                .replace(".", "")
+            )
+
+        except Exception as e:
+            raise Exception("Failed to get site php version") from e
+
+        if (
+            site_conf.get("php_version")
+            and site_conf.get("php_version") != site_php_version
+        ):
+            # update site php version
+            self.wait_for_php_version()
+            self.logger.debug(
+                f"php version changed from {site_php_version} to {site_conf.get('php_version')}, updating..."
+            )
+            forge_api.update_site(
+                server_id, site_id, php_version=site_conf.get("php_version")
+            )
+            self.logger.info(f"Php version set to {site_conf.get('php_version')}")
+
+    # create daemons
+    def sync_daemons(self):
+        snapshot, site_conf = self.snapshot, self.site_conf
+        try:
+            diff = snapshot.daemon_diff(self.site_dir, site_conf["processes"])
+            daemon_ids = [dm["id"] for dm in diff.keep]
+
+            # delete daemons not in the config
+            for dm in diff.delete:
+                snapshot.delete_daemon(dm["id"])
+                self.logger.info(
+                    f"Daemon-{dm['id']} `{dm['attributes']['command']}` deleted."
+                )
+
+            # add new daemons
+            for process in diff.create:
+                # supervisor starts the process right away
+                self.wait_for_php_version()
+                new_daemon = snapshot.create_daemon(
+                    process["name"],
+                    process["command"],
+                    self.site_dir,
+                    user=self.site_user,
+                )
+                daemon_ids.append(new_daemon["id"])
+                self.logger.info(
+                    f"Daemon-{new_daemon['id']} `{new_daemon['attributes']['command']}` created."
+                )
+            self.daemon_ids = daemon_ids
+        except Exception as e:
+            raise Exception(f"Failed to add daemons: {e}") from e
+
+    # ----------Scheduler----------
+    def sync_scheduler(self):
+        forge_api, server_id, site_conf = self.forge_api, self.server_id, self.site_conf
+        if site_conf["project_type"] != "laravel":
+            return
+
+        try:
+            scheduler_cmd = get_scheduler_command(
+                forge_api.get_site_by_id(server_id, self.site_id)["attributes"][
+                    "php_version"
+                ],
+                self.site_dir,
+            )
+
+            current_scheduler_job = self.snapshot.job(scheduler_cmd)
+
+            if site_conf["laravel_scheduler"] and not current_scheduler_job:
+                self.snapshot.create_job(scheduler_cmd, "minutely")
+                self.logger.info("Scheduler job created successfully")
+            elif not site_conf["laravel_scheduler"] and current_scheduler_job:
+                self.snapshot.delete_job(current_scheduler_job["id"])
+                self.logger.info("Scheduler job deleted successfully")
+
+        except Exception as e:
+            raise Exception(f"Failed to configure laravel scheduler: {e}") from e
+
+    # deployment script
+    def update_deployment_script(self):
+        site_conf = self.site_conf
+        # if deployment_script not provided, the default deployment script generated by forge is kept
+        if not site_conf.get("deployment_script"):
+            return
+
+        with self.metrics.span("deployment script", "render"):
+            deployment_script = build_deployment_script(
+                site_conf, self.site_dir, self.daemon_ids
+            )
+
+        try:
+            if self.current_script_hash is _UNKNOWN:
+                current = self.forge_api.get_deployment_script(
+                    self.server_id, self.site_id
+                )
+                self.current_script_hash = deployment_script_hash(
+                    current["attributes"]["content"] if current else None
+                )
+            if self.current_script_hash == deployment_script_hash(deployment_script):
+                self.logger.info("Deployment script is up to date")
+                return
+
+            self.forge_api.update_deployment_script(
+                self.server_id,
+                self.site_id,
+                deployment_script,
+                auto_source=False,
+            )
+        except Exception as e:
+            raise Exception(f"Failed to add deployment script: {e}") from e
+
+        self.logger.info("Deployment script added successfully")
+
+    # set env
+    def set_environment(self):
+        site_conf = self.site_conf
+        try:
+            with self.metrics.span("environment", "render"):
+                site_env = build_environment(
+                    site_conf, self.source_repo_path, self.secrets, self.logger
+                )
+
+            if self.current_env_hashes is _UNKNOWN:
+                current = self.forge_api.get_site_environment(
+                    self.server_id, self.site_id
+                )
+                self.current_env_hashes = environment_hashes(
+                    current["attributes"]["content"] if current else None
+                )
+            diff = diff_environment(
+                self.current_env_hashes,
+                environment_hashes(format_environment(site_env)),
+            )
+            if not diff:
+                self.logger.info("Environment variables are up to date")
+                return
+
+            self.forge_api.update_site_environment(
+                self.server_id, self.site_id, format_environment(site_env)
+            )
+            self.logger.info(f"Environment variables updated: {diff.describe()}")
+
+        except Exception as e:
+            raise Exception(f"Failed to set environment variables: {e}") from e
+
+    # certificate
+    def install_certificates(self):
+        forge_api, server_id, site_id = self.forge_api, self.server_id, self.site_id
+        if not self.site_conf["certificate"]:
+            return
+
+        try:
+            # Get all site domains
+            all_domains = forge_api.get_site_domains(server_id, site_id)
+        except Exception as e:
+            raise Exception(f"Failed to manage certificates: {e}") from e
+
+        # Filter out on-forge.com domains
+        domains_to_certify = [
+            domain
+            for domain in all_domains
+            if not domain["attributes"]["name"].endswith(".on-forge.com")
+        ]
+
+        # request every missing certificate first, then wait for all of them together
+        pending = {}  # domain name -> future of the installed certificate
+        failures = {}  # domain name -> reason
+        for domain in domains_to_certify:
+            domain_id = domain["id"]
+            domain_name = domain["attributes"]["name"]
+            try:
+                if forge_api.get_domain_certificate(server_id, site_id, domain_id):
+                    self.logger.info(
+                        f"Certificate already exists for domain '{domain_name}'"
+                    )
+                    continue
+
+                self.logger.info(
+                    f"Installing certificate for domain '{domain_name}'..."
+                )
+                forge_api.create_domain_certificate(server_id, site_id, domain_id)
+                pending[domain_name] = self.poller.watch(
+                    self._certificate_check(domain_id), "certificate"
+                )
+            except Exception as e:
+                failures[domain_name] = str(e)
+
+        for domain_name, future in pending.items():
+            try:
+                if future.result():
+                    self.logger.info(
+                        f"Certificate installed for domain '{domain_name}'"
+                    )
+                else:
+                    failures[domain_name] = "installation timed out"
+            except Exception as e:
+                failures[domain_name] = str(e)
+
+        for domain_name, reason in failures.items():
+            self.logger.error(
+                f"Certificate installation failed for domain '{domain_name}': {reason}"
+            )
+        if failures:
+            raise Exception(
+                "Failed to manage certificates: installation failed for domain(s) "
+                + ", ".join(f"'{name}'" for name in failures)
+            )
+
+    def _certificate_check(self, domain_id):
+        """Poller check returning the certificate of the domain once installed."""
+
+        def until_cert_installed():
+            cert = self.forge_api.get_domain_certificate(
+                self.server_id, self.site_id, domain_id
+            )
+            # Forge drops the certificate when the issuance fails
+            if not cert:
+                raise Exception("certificate was removed, issuance failed")
+            return cert if cert["attributes"]["status"] == "installed" else None
+
+        return until_cert_installed
+
+    # deploy site
+    def deploy(self):
+        deployment = self.trigger_deployment()
+        if deployment is not None:
+            self.finish_deployment(deployment)
+
+    def trigger_deployment(self) -> PendingDeployment | None:
+        """
+        Start the deployment of the site without waiting for it, its status is
+        polled in the background. None when the site isn't deployed.
+        """
+        forge_api, server_id, site_id = self.forge_api, self.server_id, self.site_id
+        if not self.site_conf["clone_repository"]:
+            return None
+
+        self.wait_for_php_version()
+        self.logger.info("Deploying site...")
+
+        # Trigger deployment and get deployment ID
+        deployment_id = forge_api.deploy_site(server_id, site_id)["id"]
+        self.logger.debug(f"Deployment ID: {deployment_id}")
+
+        # the log is printed while the deployment runs and kept in a file
+        log_stream = DeploymentLogStream(
+            os.path.join(
+                self.deployment_log_dir,
+                f"{self.site_conf['domain_name']}-{deployment_id}.log",
+            ),
+            lambda line: self.logger.info("| %s", line, extra={"live": True}),
+        )
+
+        def read_log():
+            try:
+                log = forge_api.get_deployment_log(server_id, site_id, deployment_id)
+            except Exception as e:
+                self.logger.debug(f"Failed to read deployment log: {e}")
+                return
+            log_stream.update(log["attributes"]["output"] if log else None)
+
+        log_read_at = None
+
+        # Wait until deployment is finished
+        def until_deployment_finished():
+            nonlocal log_read_at
+            status_data = forge_api.get_deployment(server_id, site_id, deployment_id)
+            status = status_data["attributes"]["status"]
+            self.logger.debug(f"Deployment status: {status}")
+
+            # failed or successful
+            if status in ["cancelled", "failed", "failed-build", "finished"]:
+                return status
+
+            # Still in progress
+            now = time.monotonic()
+            if status not in ["queued", "pending"] and (
+                log_read_at is None or now - log_read_at >= self.DEPLOYMENT_LOG_INTERVAL
+            ):
+                log_read_at = now
+                read_log()
+            return None
+
+        status = self.poller.watch(until_deployment_finished, "deployment")
+        return PendingDeployment(deployment_id, log_stream, status, read_log)
+
+    def finish_deployment(self, deployment: PendingDeployment):
+        """Wait for a deployment started by `trigger_deployment`."""
+        log_stream = deployment.log_stream
+        try:
+            final_status = deployment.status.result()
+            if not final_status:
+                raise Exception("Deployment status check timed out")
+            # end of the log
+            deployment.read_log()
+        finally:
+            log_stream.close()
+
+        if log_stream.has_output:
+            self.logger.info(f"Deployment log saved to {log_stream.path}")
+        else:
+            self.logger.warning("Deployment log not available")
+
+        # Check if deployment failed
+        if final_status in ["cancelled", "failed", "failed-build"]:
+            raise Exception(f"Deployment failed with status: {final_status}")
+
+        self.logger.info("Site deployed successfully")
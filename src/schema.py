@@ -1,8 +1,13 @@
 schema = {
     "organization": {"type": "string", "required": True},
-    "server": {"type": "string", "required": True},
+    "server": {"type": "string", "required": True, "excludes": "servers"},
     "github_repository": {"type": "string", "required": True},
     "github_branch": {"type": "string", "required": False, "default": "main"},
+    "max_parallel_sites": {
+        "type": "integer",
+        "required": False,
+        "min": 1,
+    },
     "sites": {
         "type": "list",
         "schema": {
@@ -134,9 +139,32 @@ schema = {
                     "required": False,
                     "default": True,
                 },
+                # paths, besides `root_dir`, whose changes affect the site
+                "watch_paths": {
+                    "type": "list",
+                    "required": False,
+                    "default": [],
+                    "schema": {"type": "string"},
+                },
             },
         },
         "required": False,
         "default": [],
     },
 }
+
+# several servers, each with its own sites, can be targeted instead of one `server`
+schema["servers"] = {
+    "type": "list",
+    "required": True,
+    "excludes": "server",
+    "minlength": 1,
+    "schema": {
+        "type": "dict",
+        "schema": {
+            "name": {"type": "string", "required": True},
+            "github_branch": {"type": "string", "required": False},
+            "sites": schema["sites"],
+        },
+    },
+}
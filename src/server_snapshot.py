@@ -0,0 +1,263 @@
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Iterator
+
+from forge_api import ForgeApi, ForgeApiError
+from poller import Poller
+from process_index import DaemonDiff, DaemonIndex, JobIndex
+from utils import format_php_version
+
+logger = logging.getLogger(__name__)
+
+
+def _copy_future(source: Future, target: Future):
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+class ServerSnapshot:
+    """
+    Server-wide collections (sites, php versions, daemons, scheduled jobs, nginx
+    templates) fetched at most once per run and shared by every site on the server.
+
+    Writes made through the snapshot are forwarded to the API and applied to the
+    cached collections, so they never have to be read again.
+    """
+
+    def __init__(self, forge_api: ForgeApi, server_id):
+        self.forge_api = forge_api
+        self.server_id = server_id
+
+        self._lock = threading.RLock()
+        # guards server-wide changes (php installs, nginx templates) when sites run
+        # in parallel
+        self.changes_lock = threading.Lock()
+        self._sites: dict[str, dict] = {}
+        self._sites_pages: Iterator[dict] | None = None
+        self._php_versions: list | None = None
+        self._php_installs: dict[str, Future] = {}
+        self._daemons: DaemonIndex | None = None
+        self._jobs: JobIndex | None = None
+        self._nginx_templates: dict[str, dict | None] = {}
+
+    def seed(
+        self,
+        sites=None,
+        php_versions=None,
+        daemons=None,
+        jobs=None,
+        nginx_templates: dict | None = None,
+    ):
+        """Fill the snapshot with collections already read elsewhere (ex: by the planner)."""
+        with self._lock:
+            if sites is not None:
+                self._sites = {site["attributes"]["name"]: site for site in sites}
+                self._sites_pages = iter(())
+            if php_versions is not None:
+                self._php_versions = list(php_versions)
+            if daemons is not None:
+                self._daemons = DaemonIndex(daemons)
+            if jobs is not None:
+                self._jobs = JobIndex(jobs)
+            if nginx_templates is not None:
+                self._nginx_templates.update(nginx_templates)
+
+    # --- Sites ---
+    def site(self, name) -> dict | None:
+        """Find a site by name, fetching pages of the site list only until it shows up."""
+        with self._lock:
+            if name in self._sites:
+                return self._sites[name]
+
+            if self._sites_pages is None:
+                self._sites_pages = self.forge_api.iter_sites(self.server_id)
+
+            for site in self._sites_pages:
+                self._sites[site["attributes"]["name"]] = site
+                if site["attributes"]["name"] == name:
+                    return site
+            return None
+
+    # --- Php ---
+    def php_versions(self):
+        with self._lock:
+            if self._php_versions is None:
+                self._php_versions = self.forge_api.get_server_installed_php_versions(
+                    self.server_id
+                )
+            return list(self._php_versions)
+
+    def has_php_version(self, version):
+        return format_php_version(version) in [
+            php["attributes"]["binary_name"] for php in self.php_versions()
+        ]
+
+    def install_php_version(self, version):
+        self.forge_api.install_php_version(self.server_id, version)
+
+    def php_version_ready(self, version, poller: Poller) -> Future:
+        """
+        Future resolved once `version` is installed on the server (False if the
+        installation timed out), starting the installation when it's missing.
+        Every site asking for the same version shares one installation.
+        """
+        with self._lock:
+            if version in self._php_installs:
+                return self._php_installs[version]
+            # placeholder for the other sites, the API is called outside the lock
+            future = self._php_installs[version] = Future()
+        try:
+            watch = self._watch_php_version(version, poller)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            watch.add_done_callback(lambda done: _copy_future(done, future))
+        return future
+
+    def _watch_php_version(self, version, poller: Poller) -> Future:
+        binary_name = format_php_version(version)
+        php = next(
+            (
+                p
+                for p in self.php_versions()
+                if p["attributes"]["binary_name"] == binary_name
+            ),
+            None,
+        )
+        if php and php["attributes"]["status"] == "installed":
+            future = Future()
+            future.set_result(php)
+            return future
+
+        if not php:
+            try:
+                self.install_php_version(version)
+            except Exception as e:
+                # another run (ex: a shard) may have started the same installation
+                try:
+                    php = self.get_php_version(version)
+                except Exception:
+                    php = None
+                if not php:
+                    future = Future()
+                    future.set_exception(e)
+                    return future
+
+        def until_php_installed():
+            installed_php = self.get_php_version(version)
+            if not installed_php:
+                raise Exception("Php version not found after installation")
+            if installed_php["attributes"]["status"] == "installed":
+                return installed_php
+            return None
+
+        return poller.watch(until_php_installed, "php")
+
+    def get_php_version(self, version):
+        """Fetch the current state of a php version and store it in the snapshot."""
+        php = self.forge_api.get_php_version(self.server_id, version)
+        if php:
+            with self._lock:
+                self.php_versions()
+                self._php_versions = [  # type: ignore
+                    p for p in self._php_versions if p["id"] != php["id"]  # type: ignore
+                ] + [php]
+        return php
+
+    # --- Daemons ---
+    def _daemon_index(self) -> DaemonIndex:
+        with self._lock:
+            if self._daemons is None:
+                self._daemons = DaemonIndex(
+                    self.forge_api.get_server_daemons(self.server_id)
+                )
+            return self._daemons
+
+    def daemon_diff(self, directory, processes) -> DaemonDiff:
+        """Compare the daemons running in `directory` with the configured processes."""
+        with self._lock:
+            return self._daemon_index().diff(directory, processes)
+
+    def create_daemon(self, name, command, directory, user="forge"):
+        daemon = self.forge_api.create_daemon(
+            self.server_id, name, command, directory, user=user
+        )
+        with self._lock:
+            self._daemon_index().add(daemon)
+        return daemon
+
+    def delete_daemon(self, daemon_id):
+        self.forge_api.delete_daemon(self.server_id, daemon_id)
+        with self._lock:
+            self._daemon_index().remove(daemon_id)
+
+    # --- Cron Jobs ---
+    def _job_index(self) -> JobIndex:
+        with self._lock:
+            if self._jobs is None:
+                self._jobs = JobIndex(self.forge_api.get_server_jobs(self.server_id))
+            return self._jobs
+
+    def job(self, command) -> dict | None:
+        """Scheduled job running `command`, None if there is none."""
+        with self._lock:
+            return self._job_index().find(command)
+
+    def create_job(self, cmd, frequency, user="forge"):
+        job = self.forge_api.create_job(self.server_id, cmd, frequency, user=user)
+        with self._lock:
+            self._job_index().add(job)
+        return job
+
+    def delete_job(self, job_id):
+        self.forge_api.delete_job(self.server_id, job_id)
+        with self._lock:
+            self._job_index().remove(job_id)
+
+    # --- nginx ---
+    def nginx_template(self, name) -> dict | None:
+        with self._lock:
+            if name not in self._nginx_templates:
+                self._nginx_templates[name] = (
+                    self.forge_api.get_nginx_templates_by_name(self.server_id, name)
+                )
+            return self._nginx_templates[name]
+
+    def create_nginx_template(self, name, content):
+        """
+        Create a template, or use the one another run (ex: a shard) created at the
+        same time. Every run settles on the oldest template of that name and
+        deletes the one it created if it lost.
+        """
+        template_id, error = None, None
+        try:
+            template_id = self.forge_api.create_nginx_template(
+                self.server_id, name, content
+            )
+        except ForgeApiError as e:
+            error = e
+        existing = self.forge_api.get_nginx_templates_by_name(self.server_id, name)
+        if existing:
+            if template_id is not None and template_id != existing["id"]:
+                # also drops the cached listing, so no run keeps reading the
+                # duplicate or a listing from before the template existed
+                try:
+                    self.forge_api.delete_nginx_template(self.server_id, template_id)
+                except ForgeApiError as e:
+                    logger.warning(
+                        f"Failed to delete duplicate nginx template {template_id}: {e}"
+                    )
+            template_id = existing["id"]
+        elif error is not None:
+            raise error
+        with self._lock:
+            self._nginx_templates[name] = existing or {
+                "id": template_id,
+                "attributes": {"name": name},
+            }
+        return template_id
@@ -0,0 +1,24 @@
+import hashlib
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """Parse a `k/n` shard, the k-th of n (1-based)."""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError as e:
+        raise Exception(f"Invalid shard `{value}`, expected `k/n` (ex: 2/4)") from e
+    if count < 1 or not 1 <= index <= count:
+        raise Exception(f"Invalid shard `{value}`, expected 1 <= k <= n")
+    return index, count
+
+
+def site_shard(domain_name: str, count: int) -> int:
+    """
+    Shard (1-based) of a site among `count`, by rendezvous hashing of its domain
+    name: stable between runs and independent of the other sites, and changing the
+    number of shards only moves the sites of the added or removed shards.
+    """
+    return 1 + max(
+        range(count),
+        key=lambda i: hashlib.sha256(f"{i}:{domain_name}".encode()).digest(),
+    )
@@ -0,0 +1,111 @@
+import logging
+import os
+import sys
+import threading
+from typing import Callable
+
+# serializes flushing of buffered site logs so groups never interleave
+_output_lock = threading.Lock()
+
+
+class _RecordBuffer(logging.Handler):
+    """
+    Logging handler that keeps records in memory until they are flushed. Records
+    logged with `extra={"live": True}` are written right away instead, prefixed
+    with the site name.
+    """
+
+    def __init__(self, site_name: str):
+        super().__init__()
+        self.site_name = site_name
+        self.records: list[logging.LogRecord] = []
+
+    def emit(self, record):
+        if not getattr(record, "live", False):
+            self.records.append(record)
+            return
+
+        live_record = logging.makeLogRecord(
+            {
+                **record.__dict__,
+                "msg": f"[{self.site_name}] {record.getMessage()}",
+                "args": None,
+            }
+        )
+        with _output_lock:
+            logging.getLogger().handle(live_record)
+
+
+class SiteLog:
+    """
+    Per-site logger.
+
+    When `buffered` is True (sites reconciled in parallel), records are held back
+    and written as one GitHub Actions log group once the site is done, so the
+    output of concurrent sites doesn't interleave.
+    """
+
+    def __init__(self, site_name: str, buffered: bool = False):
+        self.site_name = site_name
+        self.logger = logging.getLogger(f"site.{site_name}")
+        self._buffer = None
+
+        if buffered:
+            self._buffer = _RecordBuffer(site_name)
+            self.logger.addHandler(self._buffer)
+            self.logger.propagate = False
+
+    def flush(self):
+        if self._buffer is None or not self._buffer.records:
+            return
+
+        root_logger = logging.getLogger()
+        with _output_lock:
+            print(f"::group::Site: {self.site_name}", flush=True)
+            for record in self._buffer.records:
+                root_logger.handle(record)
+            sys.stdout.flush()
+            print("::endgroup::", flush=True)
+
+        self._buffer.records.clear()
+
+
+class DeploymentLogStream:
+    """
+    Follows the log of a running deployment. Forge returns the whole log on each
+    request, `update()` writes the part not seen yet to the log file and emits its
+    complete lines, so the log is never held or logged as one string.
+    """
+
+    def __init__(self, path: str, emit: Callable[[str], None]):
+        self.path = path
+        self.emit = emit
+        self._offset = 0
+        self._partial_line = ""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "w")
+
+    @property
+    def has_output(self) -> bool:
+        return self._offset > 0
+
+    def update(self, output: str | None):
+        if not output or len(output) <= self._offset:
+            return
+        new_output = output[self._offset :]
+        self._offset = len(output)
+
+        self._file.write(new_output)
+        self._file.flush()
+
+        lines = (self._partial_line + new_output).split("\n")
+        # the last line may still be written to
+        self._partial_line = lines.pop()
+        for line in lines:
+            self.emit(line)
+
+    def close(self):
+        if self._partial_line:
+            self.emit(self._partial_line)
+            self._partial_line = ""
+        self._file.close()
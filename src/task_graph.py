@@ -0,0 +1,89 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable
+
+
+@dataclass
+class Task:
+    name: str
+    run: Callable[[], None] | None  # None for a skipped task
+    after: list[str] = field(default_factory=list)  # tasks that must succeed first
+
+
+class TaskFailed(Exception):
+    """Raised by `run_tasks` when tasks failed, with the error of each of them."""
+
+    def __init__(self, errors: dict[str, Exception], skipped: list[str]):
+        self.errors = errors
+        self.skipped = skipped  # never started because a dependency failed
+        message = "; ".join(f"{name}: {error}" for name, error in errors.items())
+        super().__init__(message)
+
+
+def run_tasks(tasks: list[Task], max_workers: int = 4):
+    """
+    Run `tasks`, each as soon as all the tasks it comes after succeeded, so
+    independent tasks run together. Skipped tasks (without `run`) are transparent:
+    the tasks after them wait for their dependencies instead. When a task fails,
+    the tasks depending on it are skipped and the others still run. Raises
+    `TaskFailed` if any task failed.
+    """
+    by_name = {task.name: task for task in tasks}
+    for task in tasks:
+        for name in task.after:
+            if name == task.name:
+                raise ValueError(f"Task `{task.name}` depends on itself")
+            if name not in by_name:
+                raise ValueError(f"Task `{task.name}` depends on unknown `{name}`")
+
+    def dependencies(name, through=()):
+        """Tasks to run before `name`, looking through the skipped ones."""
+        found = set()
+        for dep in by_name[name].after:
+            if by_name[dep].run is not None:
+                found.add(dep)
+            elif dep in through:
+                raise ValueError(f"Dependency cycle between tasks {list(through)}")
+            else:
+                found |= dependencies(dep, (*through, dep))
+        return found
+
+    runnable = [task for task in tasks if task.run is not None]
+    waiting_on = {task.name: dependencies(task.name) for task in runnable}
+    pending = [task.name for task in runnable]  # not started, in the given order
+    running: dict[Future, str] = {}
+    errors: dict[str, Exception] = {}
+    skipped: list[str] = []
+
+    with ThreadPoolExecutor(max_workers, thread_name_prefix="step") as executor:
+        while pending or running:
+            for name in [n for n in pending if not waiting_on[n]]:
+                pending.remove(name)
+                running[executor.submit(by_name[name].run)] = name  # type: ignore
+
+            if not running:
+                raise ValueError(f"Dependency cycle between tasks {pending}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                if error is None:
+                    for deps in waiting_on.values():
+                        deps.discard(name)
+                    continue
+
+                errors[name] = error
+                # drop everything depending on the failed task, transitively
+                failed = [name]
+                while failed:
+                    failed_name = failed.pop()
+                    for dependent in [
+                        n for n in pending if failed_name in waiting_on[n]
+                    ]:
+                        pending.remove(dependent)
+                        skipped.append(dependent)
+                        failed.append(dependent)
+
+    if errors:
+        raise TaskFailed(errors, skipped)
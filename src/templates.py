@@ -0,0 +1,139 @@
+import os
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Mapping
+
+# ${{ secrets.SECRET_VAR }} and ${{ env.ENV_VAR }}, in the deployment file and env files
+_EXPRESSION_PATTERN = re.compile(r"\$\{\{\s*(secrets|env)\.(\w+)\s*\}\}")
+# {{ variable }}, in nginx templates
+_VARIABLE_PATTERN = re.compile(r"{{(.*?)}}")
+
+
+@dataclass(frozen=True)
+class Placeholder:
+    source: str  # secrets | env | variables
+    name: str
+
+    def describe(self) -> str:
+        if self.source == "secrets":
+            return f"Secret '{self.name}' value is not set."
+        if self.source == "env":
+            return f"Environment variable '{self.name}' is not set."
+        return f"Variable '{self.name}' value is not set."
+
+
+class MissingValuesError(ValueError):
+    """Raised with every placeholder of a render that has no value."""
+
+    def __init__(self, missing: list[Placeholder]):
+        self.missing = missing
+        super().__init__(" ".join(placeholder.describe() for placeholder in missing))
+
+
+Segments = tuple[str | Placeholder, ...]
+
+
+@lru_cache(maxsize=4096)
+def compile_expressions(text: str) -> Segments:
+    """Split `text` into literal strings and `${{ secrets.X }}` / `${{ env.X }}` placeholders."""
+    return _compile(
+        text,
+        _EXPRESSION_PATTERN,
+        lambda match: Placeholder(match.group(1), match.group(2).upper()),
+    )
+
+
+@lru_cache(maxsize=256)
+def compile_variables(text: str) -> Segments:
+    """Split `text` into literal strings and `{{ variable }}` placeholders."""
+    return _compile(
+        text,
+        _VARIABLE_PATTERN,
+        lambda match: Placeholder("variables", match.group(1).strip()),
+    )
+
+
+def _compile(text, pattern, placeholder) -> Segments:
+    segments = []
+    position = 0
+    for match in pattern.finditer(text):
+        if match.start() > position:
+            segments.append(text[position : match.start()])
+        segments.append(placeholder(match))
+        position = match.end()
+    if position < len(text):
+        segments.append(text[position:])
+    return tuple(segments)
+
+
+def _render(segments: Segments, sources: dict[str, Mapping], missing: list) -> str:
+    parts = []
+    for segment in segments:
+        if isinstance(segment, str):
+            parts.append(segment)
+            continue
+        try:
+            parts.append(str(sources[segment.source][segment.name]))
+        except KeyError:
+            if segment not in missing:
+                missing.append(segment)
+    return "".join(parts)
+
+
+def render_expressions(data, secrets: Mapping | None):
+    """
+    Replace the `${{ secrets.X }}` and `${{ env.X }}` placeholders of every string in
+    `data` (a string or nested dicts and lists) in one pass. Strings and containers
+    without placeholders are returned as is. Raises `MissingValuesError` listing
+    every placeholder without a value.
+    """
+    missing = []
+    sources = {"secrets": secrets or {}, "env": os.environ}
+    result = _render_tree(data, sources, missing)
+    if missing:
+        raise MissingValuesError(missing)
+    return result
+
+
+def _render_tree(data, sources, missing):
+    if isinstance(data, str):
+        if "${{" not in data:
+            return data
+        return _render(compile_expressions(data), sources, missing)
+
+    if isinstance(data, dict):
+        rendered = None
+        for key, value in data.items():
+            new_value = _render_tree(value, sources, missing)
+            if new_value is not value:
+                if rendered is None:
+                    rendered = dict(data)
+                rendered[key] = new_value
+        return data if rendered is None else rendered
+
+    if isinstance(data, list):
+        rendered = None
+        for i, value in enumerate(data):
+            new_value = _render_tree(value, sources, missing)
+            if new_value is not value:
+                if rendered is None:
+                    rendered = list(data)
+                rendered[i] = new_value
+        return data if rendered is None else rendered
+
+    return data
+
+
+def render_variables(text: str, variables: Mapping) -> str:
+    """
+    Replace the `{{ variable }}` placeholders of `text`. Raises `MissingValuesError`
+    listing every variable without a value.
+    """
+    if "{{" not in text:
+        return text
+    missing = []
+    result = _render(compile_variables(text), {"variables": variables}, missing)
+    if missing:
+        raise MissingValuesError(missing)
+    return result
@@ -0,0 +1,201 @@
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Thread-safe token bucket limiting how many requests are sent per minute."""
+
+    def __init__(self, requests_per_minute: float, capacity: float | None = None):
+        self.rate = requests_per_minute / 60  # tokens per second
+        self.capacity = capacity if capacity is not None else requests_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take one token and return how long the caller must wait before using it.
+        Tokens may be borrowed in advance, so concurrent callers queue up in order.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            self.tokens -= 1
+
+            delay = max(self.paused_until - now, -self.tokens / self.rate, 0)
+            return delay
+
+    def acquire(self) -> float:
+        """Take one token, sleeping until it is available. Returns the time waited."""
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def pause(self, seconds: float):
+        """Hold back every caller for `seconds` (used when the API says we are throttled)."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = min(self.tokens, 0)
+
+
+@dataclass
+class TransportStats:
+    requests: int = 0
+    throttled: int = 0
+    retried: int = 0
+    budget_wait: float = 0.0  # seconds spent waiting for the request budget
+
+    def __add__(self, other: "TransportStats") -> "TransportStats":
+        return TransportStats(
+            self.requests + other.requests,
+            self.throttled + other.throttled,
+            self.retried + other.retried,
+            self.budget_wait + other.budget_wait,
+        )
+
+
+class RateLimitedSession(requests.Session):
+    """
+    `requests.Session` that keeps under the Forge API rate limit.
+
+    - every request takes a token from a shared token bucket
+    - 429 responses are retried after `Retry-After` (the request wasn't processed)
+    - GET and PUT requests are also retried on 502/503/504 and connection errors,
+      honoring `Retry-After` when given, otherwise with jittered exponential backoff
+    - with `metrics`, each request is recorded once, its retries included
+    """
+
+    RETRY_METHODS = {"GET", "PUT"}
+    RETRY_STATUSES = {502, 503, 504}
+
+    def __init__(
+        self,
+        requests_per_minute: float = 60,
+        max_retries: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30,
+        bucket: TokenBucket | None = None,
+        metrics: Metrics | None = None,
+    ):
+        super().__init__()
+        self.bucket = bucket or TokenBucket(requests_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stats = TransportStats()
+        self._stats_lock = threading.Lock()
+        self.metrics = metrics
+
+    def request(self, method, url, *args, **kwargs):
+        method = method.upper()
+        start = self.metrics.now() if self.metrics else 0.0
+        retries = 0
+
+        def record(response=None):
+            if self.metrics is None:
+                return
+            if response is None:
+                self.metrics.record_call(method, url, None, start, retries=retries)
+                return
+            self.metrics.record_call(
+                method,
+                url,
+                response.status_code,
+                start,
+                bytes_sent=len(response.request.body or b""),
+                bytes_received=len(response.content),
+                retries=retries,
+            )
+
+        while True:
+            waited = self.bucket.acquire()
+            with self._stats_lock:
+                self.stats.requests += 1
+                self.stats.budget_wait += waited
+            if waited and self.metrics:
+                self.metrics.add_span(
+                    "rate limit", "sleep", self.metrics.now() - waited, waited
+                )
+
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if method not in self.RETRY_METHODS or retries >= self.max_retries:
+                    record()
+                    raise
+                delay = self._backoff(retries)
+                logger.debug(f"{method} {url} failed ({e}), retrying in {delay:.1f}s")
+            else:
+                status = response.status_code
+                if status == 429:
+                    with self._stats_lock:
+                        self.stats.throttled += 1
+                    if retries >= self.max_retries:
+                        record(response)
+                        return response
+                    delay = self._retry_after(response) or self._backoff(retries)
+                    # throttling applies to the whole token, hold back every thread
+                    self.bucket.pause(delay)
+                    logger.debug(f"{method} {url} throttled, retrying in {delay:.1f}s")
+                elif (
+                    status in self.RETRY_STATUSES
+                    and method in self.RETRY_METHODS
+                    and retries < self.max_retries
+                ):
+                    delay = self._retry_after(response) or self._backoff(retries)
+                    logger.debug(
+                        f"{method} {url} returned {status}, retrying in {delay:.1f}s"
+                    )
+                else:
+                    record(response)
+                    return response
+
+            retries += 1
+            with self._stats_lock:
+                self.stats.retried += 1
+            if self.metrics:
+                self.metrics.add_span(
+                    "retry backoff", "sleep", self.metrics.now(), delay
+                )
+            time.sleep(delay)
+
+    def _backoff(self, retries: int) -> float:
+        return backoff_delay(retries, self.backoff_base, self.backoff_max)
+
+    def _retry_after(self, response) -> float | None:
+        return retry_after_delay(response.headers.get("Retry-After"))
+
+
+def backoff_delay(retries: int, base: float = 0.5, cap: float = 30) -> float:
+    # "full jitter" exponential backoff
+    return random.uniform(0, min(cap, base * 2**retries))
+
+
+def retry_after_delay(value: str | None) -> float | None:
+    """Seconds to wait from a `Retry-After` header (delay in seconds or HTTP date)."""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    # spread the retries of concurrent callers a little
+    return max(seconds, 0) + random.uniform(0, 1)
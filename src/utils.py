@@ -1,16 +1,17 @@
 import logging
-import os
 import re
-import time
 from pathlib import Path
 
-from schema import schema
-from validator import ConfigValidator
+from templates import render_expressions, render_variables
 
 logger = logging.getLogger(__name__)
 
 
 def validate_yaml_data(data):
+    # Cerberus is only imported when a deployment file has to be validated
+    from schema import schema
+    from validator import ConfigValidator
+
     v = ConfigValidator(schema, purge_unknown=True)  # type: ignore
     v.allow_default_values = True  # type: ignore
     if not v.validate(data, normalize=True):  # type: ignore
@@ -19,67 +20,13 @@ def validate_yaml_data(data):
 
 
 def replace_secrets_and_envs_yaml(data, secrets: dict | None):
-    if isinstance(data, dict):
-        return {
-            key: replace_secrets_and_envs_yaml(value, secrets)
-            for key, value in data.items()
-        }
-    elif isinstance(data, list):
-        return [replace_secrets_and_envs_yaml(item, secrets) for item in data]
-    elif isinstance(data, str):
-        # regex matches secrets in the form ${{ secrets.SECRET_VAR }}
-        secrets_pattern = re.compile(r"\$\{\{\s*secrets\.(\w+)\s*\}\}")
-        # regex matches env vars in the form ${{ env.ENV_VAR }}
-        env_pattern = re.compile(r"\$\{\{\s*env\.(\w+)\s*\}\}")
-
-        def replace_secret_match(match):
-            secret_name = match.group(1).upper()
-            if secrets is None or secret_name not in secrets:
-                raise ValueError(f"Secret '{secret_name}' value is not set.")
-            return secrets[secret_name]
-
-        def replace_env_match(match):
-            env_name = match.group(1).upper()
-            if env_name not in os.environ:
-                raise ValueError(f"Environment variable '{env_name}' is not set.")
-            return os.environ[env_name]
-
-        # Replace secrets first, then env vars
-        result = secrets_pattern.sub(replace_secret_match, data)
-        result = env_pattern.sub(replace_env_match, result)
-        return result
-    else:
-        return data
+    """Replace `${{ secrets.X }}` and `${{ env.X }}` in `data` (see `templates`)."""
+    return render_expressions(data, secrets)
 
 
 def replace_nginx_variables(nginx_conf, variables):
-    pattern = re.compile(r"{{(.*?)}}")
-
-    def replace_match(match):
-        var_name = match.group(1).strip()
-
-        try:
-            var_value = variables[var_name]
-        except KeyError:
-            raise ValueError(f"Variable '{var_name}' value is not set.")
-
-        return str(var_value)
-
-    return pattern.sub(replace_match, nginx_conf)
-
-
-def wait(callback, max_retries=8):
-    retries = 0
-    timeout = 0.5
-    max_timeout = 30
-    # max_retries < 0 means infinite retries
-    while max_retries < 0 or retries <= max_retries:
-        if callback():
-            return True
-        time.sleep(timeout)
-        retries += 1
-        timeout = min(timeout * 2, max_timeout)
-    return False
+    """Replace `{{ variable }}` in an nginx config (see `templates`)."""
+    return render_variables(nginx_conf, variables)
 
 
 def parse_env(env: str | None) -> dict[str, str]:
@@ -87,7 +34,7 @@ def parse_env(env: str | None) -> dict[str, str]:
         return {}
     parsed_env = {}
     for line in env.strip().split("\n"):
-        if line:
+        if line.strip() and not line.lstrip().startswith("#"):
             try:
                 key, value = line.split("=", 1)
                 parsed_env[key.strip().upper()] = value.strip()